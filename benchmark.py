@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pytz import timezone
+from filesync import FileInfo, FileStoreProvider, WebDavStoreProvider, sync_folder, compute_hash, changed_files
+from webdav_server import WebDavServer
+
+
+
+class LegacyFileInfo:
+    # FileInfo layout before __slots__ and epoch timestamps. Used as baseline only
+
+    def __init__(self, provider, root:str, path: str, size: int, last_modified: datetime, is_dir: bool = False):
+        self.provider = provider
+        self.root = root
+        self.path = path
+        self.size = size
+        self.last_modified = last_modified
+        self.is_dir = is_dir
+
+
+def synthetic_paths(num_files: int, files_per_dir: int = 100):
+    return ["/dir" + str(i // files_per_dir) + "/file" + str(i) + ".jpg" for i in range(num_files)]
+
+
+def tree_memory(create_fileinfo, paths) -> int:
+    tracemalloc.start()
+    try:
+        tree = {}
+        for path in paths:
+            tree[path] = create_fileinfo(path)
+        size, peak = tracemalloc.get_traced_memory()
+        return size
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_memory(num_files: int = 1000000):
+    provider = FileStoreProvider("/media/data")
+    epoch = 1700000000
+    paths = synthetic_paths(num_files)  # allocated before tracing. Both representations share the path strings
+    legacy = tree_memory(lambda path: LegacyFileInfo(provider, provider.address, path, 4096, datetime.fromtimestamp(epoch, tz=timezone('UTC'))), paths)
+    compact = tree_memory(lambda path: FileInfo(provider, provider.address, path, 4096, epoch), paths)
+    return {"files": num_files,
+            "legacy_bytes": legacy,
+            "compact_bytes": compact,
+            "legacy_bytes_per_file": round(legacy / num_files, 1),
+            "compact_bytes_per_file": round(compact / num_files, 1),
+            "reduction": round(1 - compact / legacy, 3)}
+
+
+
+# synthetic trees: name -> (number of dirs, files per dir, file size, dir depth)
+SCENARIOS = {
+    "small_files": (20, 100, 1024, 1),
+    "huge_files": (1, 3, 20 * 1024 * 1024, 1),
+    "deep": (40, 10, 4096, 8),
+    "wide": (500, 2, 4096, 1),
+}
+
+
+def generate_tree(dir: str, num_dirs: int, files_per_dir: int, file_size: int, depth: int, scale: float = 1):
+    num_dirs = max(1, int(num_dirs * scale))
+    payload = os.urandom(min(file_size, 1024 * 1024))
+    for d in range(num_dirs):
+        # each dir is a chain of depth nested dirs. The files are placed in the innermost one
+        subdir = os.path.join(dir, *["d" + str(d) + "_" + str(level) for level in range(depth)])
+        os.makedirs(subdir, exist_ok=True)
+        for f in range(files_per_dir):
+            with open(os.path.join(subdir, "file" + str(f) + ".bin"), "wb") as file:
+                remaining = file_size
+                while remaining > 0:
+                    chunk = payload[:remaining]
+                    file.write(chunk)
+                    remaining -= len(chunk)
+
+
+def timed(function):
+    start = time.time()
+    result = function()
+    return result, round(time.time() - start, 4)
+
+
+def benchmark_scenario(name: str, server: WebDavServer, workdir: str, num_workers: int, scale: float = 1):
+    num_dirs, files_per_dir, file_size, depth = SCENARIOS[name]
+    local_dir = os.path.join(workdir, name + "_" + str(num_workers) + "_local")
+    download_dir = os.path.join(workdir, name + "_" + str(num_workers) + "_download")
+    remote_dir = "/" + name + "_" + str(num_workers)
+    os.makedirs(os.path.join(server.root, remote_dir.lstrip("/")))
+    generate_tree(local_dir, num_dirs, files_per_dir, file_size, depth, scale)
+    remote_address = server.address(remote_dir)
+    result = {"scenario": name, "workers": num_workers}
+
+    server.reset_counters()
+    num_files, result["sync_upload_sec"] = timed(lambda: sync_folder(local_dir, remote_address, ignore_hash=True, workdir=workdir, num_workers=num_workers))
+    result["files"] = num_files
+    result["sync_upload_requests"] = dict(server.num_requests)
+
+    local_tree, result["info_tree_local_sec"] = timed(lambda: FileStoreProvider(local_dir).info_tree(False, num_workers))
+    server.reset_counters()
+    remote_tree, result["info_tree_webdav_sec"] = timed(lambda: WebDavStoreProvider(remote_address).info_tree(False, num_workers))
+    result["info_tree_webdav_requests"] = dict(server.num_requests)
+    _, result["compute_hash_sec"] = timed(lambda: compute_hash(local_tree))
+    _, result["compare_sec"] = timed(lambda: changed_files(local_tree, remote_tree, []))
+
+    server.reset_counters()
+    _, result["sync_download_sec"] = timed(lambda: sync_folder(remote_address, download_dir, ignore_hash=True, workdir=workdir, num_workers=num_workers))
+    result["sync_download_requests"] = dict(server.num_requests)
+
+    server.reset_counters()
+    _, result["sync_unchanged_sec"] = timed(lambda: sync_folder(local_dir, remote_address, ignore_hash=True, workdir=workdir, num_workers=num_workers))
+    result["sync_unchanged_requests"] = dict(server.num_requests)
+    return result
+
+
+def benchmark_sync(scenarios, worker_counts, latency_sec: float = 0, bandwidth: int = 0, scale: float = 1):
+    workdir = tempfile.mkdtemp(prefix="filesync_benchmark_")
+    server = WebDavServer(os.path.join(workdir, "remote"), latency_sec=latency_sec, bandwidth=bandwidth)
+    os.makedirs(server.root)
+    server.start()
+    try:
+        return [benchmark_scenario(name, server, workdir, num_workers, scale) for name in scenarios for num_workers in worker_counts]
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="filesync benchmark against a local WebDAV stand-in server")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS.keys()), help="comma separated list of " + ", ".join(SCENARIOS.keys()))
+    parser.add_argument("--workers", default="1,4", help="comma separated list of worker counts")
+    parser.add_argument("--latency", type=float, default=0.0, help="injected latency per request in sec")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bandwidth per connection in bytes/sec (0 = unlimited)")
+    parser.add_argument("--scale", type=float, default=1.0, help="scales the number of dirs of the synthetic trees")
+    parser.add_argument("--memory-files", type=int, default=1000000, help="number of files of the memory benchmark (0 = skip)")
+    parser.add_argument("--output", default=None, help="json result file (default: stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.WARNING, datefmt='%Y-%m-%d %H:%M:%S')
+    results = {"timestamp": datetime.now().isoformat(),
+               "python": sys.version.split()[0],
+               "latency_sec": args.latency,
+               "bandwidth": args.bandwidth,
+               "scale": args.scale,
+               "sync": benchmark_sync(args.scenarios.split(","), [int(workers) for workers in args.workers.split(",")], args.latency, args.bandwidth, args.scale)}
+    if args.memory_files > 0:
+        results["memory"] = benchmark_memory(args.memory_files)
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,141 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+
+def file_checksums(path: str) -> Dict[str, str]:
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if len(chunk) == 0:
+                break
+            md5.update(chunk)
+            sha1.update(chunk)
+    return {"md5": md5.hexdigest(), "sha1": sha1.hexdigest()}
+
+
+def block_signatures(path: str, block_size: int) -> List[str]:
+    # md5 of each block of the file
+    signatures = []
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            signatures.append(hashlib.md5(block).hexdigest())
+    return signatures
+
+
+def remote_checksums(checksums: Optional[str], etag: Optional[str] = None) -> Dict[str, str]:
+    # checksums as provided by ownCloud/Nextcloud (oc:checksums), e.g. "SHA1:2fd4e1c6... MD5:9e107d9d..."
+    # An etag consisting of 32 hex digits is taken as MD5 (as provided by S3 like servers for non multipart uploads).
+    # So an etag is passed only for servers known to do so. Other etags (e.g. of Nextcloud) are no content hashes
+    result = {}
+    if etag is not None:
+        etag = etag.strip('"').lower()
+        if len(etag) == 32 and all(c in "0123456789abcdef" for c in etag):
+            result["md5"] = etag
+    if checksums is not None:
+        for checksum in checksums.split():
+            if ":" in checksum:
+                algorithm, value = checksum.split(":", 1)
+                result[algorithm.lower()] = value.lower()
+    return result
+
+
+def is_same_content(checksums: Dict[str, str], other_checksums: Dict[str, str]) -> Optional[bool]:
+    # None, if there is no common algorithm
+    for algorithm in ("sha1", "md5"):
+        if algorithm in checksums.keys() and algorithm in other_checksums.keys():
+            return checksums[algorithm] == other_checksums[algorithm]
+    return None
+
+
+
+class ChecksumCache:
+    """
+    checksums of local files stored in <workdir>/checksums.db. An entry is valid as long as inode, size and
+    modification time of the file are unchanged, so an unchanged file is never hashed twice
+    """
+
+    def __init__(self, workdir: str, num_threads: int = None):
+        self.num_threads = num_threads
+        self.__conn = sqlite3.connect(os.path.join(workdir, "checksums.db"), timeout=60)
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT, sha1 TEXT)")
+
+    def close(self):
+        self.__conn.close()
+
+    def checksums(self, paths: List[str]) -> Dict[str, Dict[str, str]]:
+        result = {}
+        missing = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logging.warning("could not read " + path + " " + str(e))
+                continue
+            row = self.__conn.execute("SELECT md5, sha1 FROM checksums WHERE path = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                                      (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)).fetchone()
+            if row is None:
+                missing[path] = stat
+            else:
+                result[path] = {"md5": row[0], "sha1": row[1]}
+
+        if len(missing) > 0:
+            # hashlib releases the GIL while hashing, so threads hash in parallel. Processes would be forked
+            # by the multithreaded service
+            logging.info("computing checksums of " + str(len(missing)) + " files")
+            with ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="checksum") as executor:
+                computed = dict(zip(missing.keys(), executor.map(file_checksums, missing.keys())))
+            with self.__conn:
+                for path, checksums in computed.items():
+                    stat = missing[path]
+                    self.__conn.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                                        (path, stat.st_ino, stat.st_size, stat.st_mtime_ns, checksums["md5"], checksums["sha1"]))
+            result.update(computed)
+        return result
+
+
+
+class SignatureStore:
+    """
+    block signatures of files uploaded to a webdav server, stored in <workdir>/checksums.db. An entry describes
+    the remote file as uploaded by the last sync (identified by its size and etag), so a modified local
+    file can be compared with the remote one without downloading it
+    """
+
+    def __init__(self, workdir: str):
+        self.__lock = threading.Lock()
+        # used by the transfer workers
+        self.__conn = sqlite3.connect(os.path.join(workdir, "checksums.db"), timeout=60, check_same_thread=False)
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS signatures (url TEXT PRIMARY KEY, size INTEGER, etag TEXT, block_size INTEGER, blocks TEXT)")
+
+    def close(self):
+        self.__conn.close()
+
+    def get(self, url: str) -> Optional[Tuple[int, str, int, List[str]]]:
+        # (size, etag, block size, block signatures) or None
+        with self.__lock:
+            row = self.__conn.execute("SELECT size, etag, block_size, blocks FROM signatures WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3].split(",") if len(row[3]) > 0 else []
+
+    def put(self, url: str, size: int, etag: str, block_size: int, signatures: List[str]):
+        with self.__lock:
+            with self.__conn:
+                self.__conn.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?)", (url, size, etag, block_size, ",".join(signatures)))
+
+    def remove(self, url: str):
+        with self.__lock:
+            with self.__conn:
+                self.__conn.execute("DELETE FROM signatures WHERE url = ?", (url,))
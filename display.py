@@ -1,4 +1,8 @@
+import time
+import logging
+import threading
 import requests
+from typing import Dict
 
 
 class Display():
@@ -6,17 +10,97 @@ class Display():
     def show(self, msg: str):
         print(msg)
 
+    def flush(self, timeout_sec: float = 10) -> bool:
+        return True
+
 
 class RemoteDisplay(Display):
+    """
+    updates the lower layer text of a remote panel. show() does not block: the message is handed over to
+    a background sender, which sends the latest message at most every MIN_INTERVAL_SEC. Messages shown in the
+    meantime are replaced by newer ones
+    """
+
+    MIN_INTERVAL_SEC = 0.5
+    TIMEOUT_SEC = (2, 5)   # connect, read
 
-    def __init__(self, display_uri: str = None):
-        self.display_uri = display_uri.strip("/")
+    def __init__(self, display_uri: str = None, min_interval_sec: float = MIN_INTERVAL_SEC):
+        self.display_uri = None if display_uri is None else display_uri.strip("/")
+        self.min_interval_sec = min_interval_sec
+        self.session = requests.Session()
+        self.__condition = threading.Condition()
+        self.__pending = None
+        self.__sending = False
+        self.__thread = None
+        self.__failing = False
 
     def show(self, msg: str):
+        if self.display_uri is None:
+            return
+        with self.__condition:
+            self.__pending = msg
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__send_loop, name="display", daemon=True)
+                self.__thread.start()
+            self.__condition.notify_all()
+
+    def flush(self, timeout_sec: float = 10) -> bool:
+        # waits until the latest message has been sent. False, if the timeout elapsed before
+        deadline = time.time() + timeout_sec
+        with self.__condition:
+            while self.__pending is not None or self.__sending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.__condition.wait(remaining)
+        return True
+
+    def __send_loop(self):
+        while True:
+            with self.__condition:
+                while self.__pending is None:
+                    self.__condition.wait()
+                msg = self.__pending
+                self.__pending = None
+                self.__sending = True
+            try:
+                self.__send(msg)
+            finally:
+                with self.__condition:
+                    self.__sending = False
+                    self.__condition.notify_all()
+            time.sleep(self.min_interval_sec)
+
+    def __send(self, msg: str):
         try:
-            if self.display_uri is not None:
-                uri = self.display_uri + "/lower_layer_text"
-                resp = requests.put(uri, json= {'lower_layer_text': msg })
-                #print(resp)
-        except Exception:
-            print("error updating panel")
+            uri = self.display_uri + "/lower_layer_text"
+            self.session.put(uri, json= {'lower_layer_text': msg }, timeout=self.TIMEOUT_SEC)
+            self.__failing = False
+        except Exception as e:
+            # logged once, not per message, while the panel is unreachable
+            if not self.__failing:
+                logging.warning("error updating panel " + self.display_uri + " " + str(e))
+            self.__failing = True
+
+
+# one display per uri, shared by all syncs. So there is one sender and one session per panel
+remote_displays: Dict[str, RemoteDisplay] = {}
+remote_displays_lock = threading.Lock()
+
+
+def remote_display(display_uri: str) -> RemoteDisplay:
+    with remote_displays_lock:
+        display = remote_displays.get(display_uri, None)
+        if display is None:
+            display = RemoteDisplay(display_uri)
+            remote_displays[display_uri] = display
+        return display
+
+
+def flush_remote_displays(timeout_sec: float = 10):
+    # the sender threads are daemons. Pending messages are lost, if the process exits before
+    with remote_displays_lock:
+        displays = list(remote_displays.values())
+    for display in displays:
+        if not display.flush(timeout_sec):
+            logging.warning("panel " + display.display_uri + " not updated within " + str(timeout_sec) + " sec")
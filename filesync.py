@@ -1,23 +1,39 @@
 import traceback
-from webdav3.client import Client
 from webdav3.exceptions import ResponseErrorCode
 from datetime import datetime
 from urllib.parse import urlparse
-from typing import List
+from typing import List, Dict, Any, Optional, Set
 from lxml import etree
-from io import BytesIO
 import dateparser
 import time
 from urllib.parse import unquote, quote
 import urllib3
 import requests
+from requests.adapters import HTTPAdapter
 from pytz import timezone
 import os
 import zlib
+import io
+import gzip
+import zipfile
+import tempfile
+import calendar
 import uuid
 import pickle
-import fnmatch
+import shutil
+import glob
+import json
 import logging
+import threading
+from manifest import Manifest, ListingCache
+from ignore import IgnoreMatcher
+from metrics import RunMetrics, store_run_summary
+from checksum import ChecksumCache, SignatureStore, remote_checksums, is_same_content, block_signatures
+from ratelimit import host_limiter, retry_after_sec, backoff_sec
+from shaping import BandwidthLimiter, ThrottledReader, TransferOrder
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from xml.sax.saxutils import escape
 
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -36,28 +52,42 @@ class Progress:
 
 class FileInfo:
 
-    def __init__(self, provider, root:str, path: str, size: int, last_modified: datetime, is_dir: bool = False):
+    # no per-instance __dict__. Trees of millions of files are held in memory during a sync
+    __slots__ = ('provider', 'root', 'path', 'size', 'last_modified_epoch', 'is_dir', 'etag', 'checksums')
+
+    def __init__(self, provider, root:str, path: str, size: int, last_modified, is_dir: bool = False, etag: str = None, checksums: str = None):
         self.provider = provider
         self.root = root
         self.path = path
         self.size = size
-        self.last_modified = last_modified
+        # epoch seconds. The datetime is created on demand only (see last_modified)
+        self.last_modified_epoch = last_modified.timestamp() if isinstance(last_modified, datetime) else last_modified
         self.is_dir = is_dir
+        self.etag = etag
+        self.checksums = checksums   # server provided checksums, e.g. "SHA1:2fd4e1c6... MD5:9e107d9d..."
 
     @property
     def filename(self) -> str:
         return self.path.split("/")[-1]
 
+    @property
+    def last_modified(self) -> datetime:
+        return datetime.fromtimestamp(self.last_modified_epoch, tz=timezone('UTC'))
+
     def copy_to(self, target_provider):
         if self.provider.type() == "local" and target_provider.type() == "webdav":
-            target_provider.write(self.root + self.path, self.path, self.last_modified.timestamp())
+            target_provider.write(self.root + self.path, self.path, self.last_modified_epoch)
         elif self.provider.type() == "webdav" and target_provider.type() == "local":
-            self.provider.read(self.path, target_provider.address + self.path, self.last_modified.timestamp())
+            self.provider.read(self.path, target_provider.address + self.path, self.last_modified_epoch)
+        elif self.provider.type() == "local" and target_provider.type() == "local":
+            target_provider.write(self.root + self.path, self.path, self.last_modified_epoch)
+        else:
+            target_provider.copy_from(self.provider, self.path, self.path, self.last_modified_epoch)
 
     def is_equals(self, other, ignore_lastmodified: bool = False, ignore_filesize: bool = False):
         if other is None:
             return False, "REASON: new"
-        if not ignore_lastmodified and self.last_modified.timestamp() > other.last_modified.timestamp():
+        if not ignore_lastmodified and self.last_modified_epoch > other.last_modified_epoch:
             return False, " REASON: 'source last modified " + self.last_modified.strftime("%Y-%m-%dT%H:%M:%S") + " > target " + other.last_modified.strftime("%Y-%m-%dT%H:%M:%S") + "'"
         if not ignore_filesize and (self.size != other.size) and self.size > 0:
             return False, " REASON: 'source size " + str(self.size) + " != target size " + str(other.size) + "'"
@@ -65,7 +95,7 @@ class FileInfo:
 
     def hashcode(self):
         hash = zlib.crc32(self.path.encode('utf-8'))
-        hash = hash ^ self.size ^ int(self.last_modified.timestamp())
+        hash = hash ^ self.size ^ int(self.last_modified_epoch)
         return abs(hash)
 
     def __repr__(self):
@@ -80,25 +110,180 @@ class FileStoreProvider:
 
     def __init__(self, address):
         self.address = address
+        self.metrics = None
+        self.ignore = None   # IgnoreMatcher. Ignored dirs are not scanned
+        self.unscanned = set()   # dirs and files, which could not be read by the scan
 
     def type(self):
         return "local"
 
-    def info_tree(self, ignore_subdirs: bool):
+    def file_info(self, path: str, size: int, last_modified_epoch: int, etag: str = None) -> FileInfo:
+        return FileInfo(self, self.address, path, size, last_modified_epoch, etag=etag)
+
+    def info_tree(self, ignore_subdirs: bool, num_workers: int = 1, depth_infinity: bool = False):
+        # os.scandir based walk. The stat result of the dir entry is reused, so a file costs no extra syscalls.
+        # With num_workers > 1 up to that many directories are scanned concurrently (useful for network filesystems)
+        files = { }
+        if ignore_subdirs:
+            for fileinfo in self.scan_dir("")[0]:
+                files[fileinfo.path] = fileinfo
+        elif num_workers <= 1:
+            files = self.walk("")
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="scandir") as executor:
+                pending = {executor.submit(self.scan_dir, "")}
+                while len(pending) > 0:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        dir_files, subdirs = future.result()
+                        for fileinfo in dir_files:
+                            files[fileinfo.path] = fileinfo
+                        for subdir in subdirs:
+                            pending.add(executor.submit(self.scan_dir, subdir))
+        return files
+
+    def walk(self, path: str):
         files = { }
-        for base, directories, filenames in os.walk(self.address):
-            if not ignore_subdirs or base == self.address:
-                base = base.replace("\\", "/")
-                for filename in filenames:
-                    full_filepath = base + "/" + filename
-                    size = os.path.getsize(full_filepath)
-                    last_modified = int(os.path.getmtime(full_filepath))
-                    filepath = full_filepath[len(self.address):]
-                    files[filepath] = FileInfo(self, self.address, filepath, size, datetime.fromtimestamp(last_modified, tz=timezone('UTC')))
+        dirs = deque([path])
+        while len(dirs) > 0:
+            dir_files, subdirs = self.scan_dir(dirs.popleft())
+            for fileinfo in dir_files:
+                files[fileinfo.path] = fileinfo
+            dirs.extend(subdirs)
         return files
 
+    def scan_dir(self, path: str):
+        # returns the files and the sub dirs of a dir (relative to the address). Like os.walk, symlinked dirs are not followed
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(self.address + path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink() and (self.ignore is None or not self.ignore.is_ignored_dir(path + "/" + entry.name)):
+                                subdirs.append(path + "/" + entry.name)
+                        else:
+                            stat = entry.stat()
+                            files.append(FileInfo(self, self.address, path + "/" + entry.name, stat.st_size, int(stat.st_mtime)))
+                    except OSError as e:
+                        logging.warning("could not read " + entry.path + " " + str(e))
+                        self.unscanned.add(path + "/" + entry.name)
+        except FileNotFoundError as e:
+            if path != "":
+                logging.warning("could not scan " + self.address + path + " " + str(e))
+                self.unscanned.add(path)
+            # a root which does not exist yet (e.g. the target of a first download) is an empty tree
+        except OSError as e:
+            logging.warning("could not scan " + self.address + path + " " + str(e))
+            self.unscanned.add(path)
+        return files, subdirs
+
+    def info_paths(self, paths: List[str], ignore_subdirs: bool = False):
+        # file info of the given paths (relative to the address). Directories are scanned completely, deleted paths are skipped
+        files = { }
+        for path in paths:
+            full_path = self.address + path
+            if os.path.isfile(full_path):
+                if not ignore_subdirs or path.count("/") == 1:
+                    stat = os.stat(full_path)
+                    files[path] = self.file_info(path, stat.st_size, int(stat.st_mtime))
+            elif os.path.isdir(full_path) and not ignore_subdirs and (self.ignore is None or not self.ignore.is_ignored_dir(path)):
+                files.update(self.walk(path))
+        return files
+
+    def write(self, local_source, path, last_modified_epoch):
+        # copied to a temp file first, so the target file is replaced atomically
+        local_target = self.address + path
+        temp_file = local_target[:local_target.rindex('/')] + "/" + WebDavStoreProvider.TEMP_PREFIX + str(uuid.uuid1()) + "_temp_" + local_target[local_target.rindex('/') + 1:]
+        try:
+            os.makedirs(os.path.dirname(local_target), exist_ok=True)
+            copy_file(local_source, temp_file)
+            os.utime(temp_file, (last_modified_epoch, last_modified_epoch))
+            os.replace(temp_file, local_target)
+        except Exception as e:
+            logging.warning("error occurred copying " + local_source + " to " + local_target + " " + str(e))
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise e
+
+    def remove(self, path: str):
+        if os.path.exists(self.address + path):
+            os.remove(self.address + path)
 
-class WebDavStoreProvider:
+    def rename(self, path: str, new_path: str):
+        os.replace(self.address + path, self.address + new_path)
+
+    def flush(self):
+        pass
+
+    def is_buffered(self, path: str) -> bool:
+        return False
+
+
+FICLONE = 0x40049409   # linux ioctl cloning a file (btrfs, xfs)
+
+
+def copy_file(source: str, target: str):
+    # the data is copied by the kernel. A reflink shares the blocks with the source, so nothing is copied at all
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            import fcntl
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except (AttributeError, OSError):
+            # copy_file_range is not available (not linux, python < 3.8) or not supported across the filesystems
+            offset = 0
+            try:
+                while offset < size:
+                    copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except (AttributeError, OSError):
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+                return
+        if offset < size:
+            raise IOError("file " + source + " truncated while copying")
+
+
+
+class ResponseStream:
+    """
+    file like view of a streamed response. Passed as request body, it is sent with a Content-Length header
+    (instead of chunked) and read piece by piece
+    """
+
+    def __init__(self, response, size: int):
+        self.response = response
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size: int = -1) -> bytes:
+        return self.response.raw.read(None if size < 0 else size)
+
+
+
+class WebDavBase:
+    """
+    listing parser, paths and settings shared by the webdav providers. Requests are made by the providers
+    (blocking or asyncio), so nothing here sends one
+    """
 
     TEMP_PREFIX = "~temp~_"
 
@@ -107,164 +292,981 @@ class WebDavStoreProvider:
             <D:prop xmlns:ms="urn:schemas-microsoft-com:">
                 <ms:Win32LastModifiedTime/>
                 <D:iscollection/>
+                <D:resourcetype/>
                 <D:getcontentlength/>
+                <D:getlastmodified/>
+                <D:getetag/>
+                <oc:checksums xmlns:oc="http://owncloud.org/ns"/>
+                <cs:getctag xmlns:cs="http://calendarserver.org/ns/"/>
             </D:prop>
         </D:propfind>'''
 
-    def __init__(self, address):
+    PROPPATCH_REQUEST = '''<?xml version="1.0" encoding="utf-8" ?>
+        <D:propertyupdate xmlns:D="DAV:">
+            <D:set>
+                <D:prop>
+                    <Win32LastModifiedTime xmlns="urn:schemas-microsoft-com:">{}</Win32LastModifiedTime>
+                </D:prop>
+            </D:set>
+        </D:propertyupdate>'''
+
+    DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+    THROTTLE_CODES = [429, 503]
+    MAX_RETRIES = 5
+
+    def __init__(self, address, chunk_size: int = DEFAULT_CHUNK_SIZE):
         host, path, username, password = parse_url(address)
+        self.host = host
         self.root = path
+        self.chunk_size = chunk_size
+        self.known_dirs = set()   # remote dirs known to exist (full remote path without trailing slash)
         self.username = username
         self.password = password
         self.address = address.replace(username + ":" + password + "@", "")
-        options = {'webdav_hostname': host,
-                   'webdav_login': username,
-                   'webdav_password': password
-                   }
-        self.client = Client(options)
-        self.client.verify = False
+        self.metrics = None
+        self.ignore = None   # IgnoreMatcher. Ignored dirs are not listed
+        self.unscanned = set()   # like the local provider. Listing errors are raised, so it stays empty
+        self.etag_md5 = False   # if set, an etag of 32 hex digits is taken as md5 of the content (S3 like servers)
 
     def type(self):
         return "webdav"
 
-    def info_tree(self, ignore_subdirs: bool=False):
-        if ignore_subdirs:
-            info = self.list_flat("/")
-        else:
-            info = self.list_deep("/")
+    def file_info(self, path: str, size: int, last_modified_epoch: int, etag: str = None) -> FileInfo:
+        return FileInfo(self, self.root, path, size, last_modified_epoch, etag=etag)
 
+    def file_tree(self, info: List[FileInfo], depth_infinity: bool = False) -> Dict[str, FileInfo]:
+        # the files of a listing by path. The listed dirs are known to exist
         files= {}
-        for fileinfo in filter(lambda fileinfo: not fileinfo.is_dir, info):
-            files[fileinfo.path] = fileinfo
-        return files
-
-    def list_deep(self, path):
-        info = self.list_flat(path)
+        self.known_dirs.add(self.root.rstrip("/"))
         for fileinfo in info:
             if fileinfo.is_dir:
-                #print("sub query " + fileinfo.path)
-                info = info + self.list_deep(quote(fileinfo.path))
+                self.known_dirs.add((self.root + fileinfo.path).rstrip("/"))
+            elif depth_infinity and self.ignore is not None and self.ignore.is_ignored_dir(fileinfo.path[:fileinfo.path.rindex("/")]):
+                # a Depth: infinity listing can not be pruned. Files of ignored dirs are dropped afterwards
+                pass
+            else:
+                files[fileinfo.path] = fileinfo
+        return files
+
+    def is_ignored_dir(self, path: str) -> bool:
+        return self.ignore is not None and self.ignore.is_ignored_dir(path)
+
+    def parse_propfind_response(self, path, content):
+        # content is the response body or an iterable of its chunks. The response is parsed while it is
+        # received, and each parsed <response> element is freed, so memory does not grow with the number of entries
+        info = []
+        entry = {}
+        parser = etree.XMLPullParser(events=("end",))
+        for chunk in ([content] if isinstance(content, bytes) else content):
+            parser.feed(chunk)
+            self.__parse_events(parser, path, entry, info)
+        parser.close()
+        self.__parse_events(parser, path, entry, info)
         return info
 
-    def list_flat(self, path):
-        r = requests.request(
-            method='propfind',
-            url=self.address + path,
-            auth=(self.username, self.password),
-            headers={"Depth": "1", "Content-Type": "application/xml"},
-            verify=False,
-            data=self.PROPFIND_REQUEST
-        )
-        r.raise_for_status()
-        try:
-            return self.parse_propfind_response(path, r.content)
-        except Exception as e:
-            logging.error("Error occurred by parsing response of " + r.text + " " + str(e))
+    def __parse_events(self, parser, path, entry, info):
+        for event, element in parser.read_events():
+            tag = element.tag
+            text = element.text
+            if tag.endswith("}href"):
+                entry["href"] = unquote(urlparse(text).path if text.startswith("http") else text)
+            elif tag.endswith("}collection"):
+                entry["is_dir"] = True
+            elif tag.endswith("}response"):
+                filepath = entry.get("href", None)
+                is_dir = entry.get("is_dir", False)
+                size = entry.get("size", 0 if is_dir else None)
+                last_modified = entry.get("last_modified", None)
+                if last_modified is None and "getlastmodified" in entry.keys():
+                    # servers not supporting the MS property (or files uploaded without setting it)
+                    last_modified = parse_date(entry["getlastmodified"])
+                if filepath is not None and size is not None and last_modified is not None:
+                    rel_path = filepath[len(self.root):]
+                    if rel_path != path and rel_path != unquote(path):
+                        # the change token of a collection is its ctag, if supported
+                        etag = entry.get("ctag", entry.get("etag", None)) if is_dir else entry.get("etag", None)
+                        info.append(FileInfo(self, self.root, rel_path, size, last_modified, is_dir, etag, entry.get("checksums", None)))
+                entry.clear()
+                # free the parsed response
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif text is None or len(text.strip()) == 0:
+                pass   # e.g. properties unknown by the server (propstat 404)
+            elif tag.endswith("}iscollection"):
+                entry["is_dir"] = text.strip() in ('true', '1')
+            elif tag.endswith("}Win32LastModifiedTime"):
+                entry["last_modified"] = parse_date(text)
+            elif tag.endswith("}getlastmodified"):
+                entry["getlastmodified"] = text
+            elif tag.endswith("}getcontentlength"):
+                entry["size"] = int(text)
+            elif tag.endswith("}getetag"):
+                entry["etag"] = text.strip()
+            elif tag.endswith("}checksum"):
+                entry["checksums"] = text.strip()
+            elif tag.endswith("}getctag"):
+                entry["ctag"] = text.strip()
+
+    def http_date(self, epoch) -> str:
+        return datetime.fromtimestamp(epoch, tz=timezone('UTC')).strftime("%a, %d %b %Y %H:%M:%S %Z")
+
+    def url(self, remote_path: str) -> str:
+        return self.host + quote(remote_path)
+
+    def delete_file(self, file):
+        if os.path.exists(file):
+            os.remove(file)
+
+    def tempfile_name(self, filenname: str, suffix: str='temp', id: str = None):
+        idx = filenname.rindex('/')
+        id = str(uuid.uuid1()) if id is None else id
+        temp_file = filenname[:idx] + "/" + self.TEMP_PREFIX + id + "_" + suffix + "_" + filenname[idx+1:]
+        return temp_file
 
-    def parse_propfind_response(self, path, binary_content):
+    def make_parents(self, filepath):
+        parent = filepath[:filepath.rindex('/')]
+        if not os.path.exists(parent):
+            try:
+                # exist_ok: parallel workers may create the same dir concurrently
+                os.makedirs(parent, exist_ok=True)
+                logging.info("directory " + parent + " created")
+            except Exception as e:
+                logging.warning("could not create parent directory " + parent)
+                raise e
+
+
+
+class WebDavStoreProvider(WebDavBase):
+
+    COLLECTION_REQUEST = '''<?xml version="1.0" encoding="utf-8" ?>
+        <D:propfind xmlns:D="DAV:">
+            <D:prop>
+                <D:getetag/>
+                <cs:getctag xmlns:cs="http://calendarserver.org/ns/"/>
+                <D:sync-token/>
+            </D:prop>
+        </D:propfind>'''
+
+    SYNC_COLLECTION_REQUEST = '''<?xml version="1.0" encoding="utf-8" ?>
+        <D:sync-collection xmlns:D="DAV:">
+            <D:sync-token>{}</D:sync-token>
+            <D:sync-level>infinite</D:sync-level>
+            <D:prop xmlns:ms="urn:schemas-microsoft-com:">
+                <ms:Win32LastModifiedTime/>
+                <D:iscollection/>
+                <D:resourcetype/>
+                <D:getcontentlength/>
+                <D:getlastmodified/>
+                <D:getetag/>
+                <oc:checksums xmlns:oc="http://owncloud.org/ns"/>
+                <cs:getctag xmlns:cs="http://calendarserver.org/ns/"/>
+            </D:prop>
+        </D:sync-collection>'''
+
+    DEFAULT_POOL_SIZE = 10
+
+    DELTA_MIN_SIZE = 8 * 1024 * 1024
+    DELTA_MAX_CHANGED = 0.5   # a delta upload is done, if at most this fraction of the file has changed
+    UNSUPPORTED_CODES = [405, 415, 501]   # answers of servers without the SabreDAV partial update extension
+
+    def __init__(self, address, chunk_size: int = WebDavBase.DEFAULT_CHUNK_SIZE, resumable_uploads: bool = False, pool_size: int = DEFAULT_POOL_SIZE, direct_upload: bool = False, max_requests_per_sec: float = 0):
+        super().__init__(address, chunk_size)
+        self.resumable_uploads = resumable_uploads
+        self.direct_upload = direct_upload and not resumable_uploads
+        self.partial_updates = True   # False, once the server has rejected a PATCH request
+        # one keep-alive connection pool for all requests (listing, checks, mkdir, move, proppatch and transfers)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.auth = (self.username, self.password)
+        self.session.verify = False
+        self.limiter = host_limiter(self.host, pool_size, max_requests_per_sec)
+        self.signatures = None   # SignatureStore. If set, large files are uploaded by delta
+        self.listing_cache = None   # ListingCache. If set, unchanged collections are not listed again
+        self.bandwidth = None   # BandwidthLimiter. If set, uploads and downloads are limited by it
+
+    def info_tree(self, ignore_subdirs: bool=False, num_workers: int = 1, depth_infinity: bool = False):
+        if ignore_subdirs:
+            info = self.list_flat("/")
+        elif self.listing_cache is not None:
+            info = self.list_cached(num_workers)
+        elif depth_infinity:
+            info = self.list_infinite("/", num_workers)
+        else:
+            info = self.list_deep("/", num_workers)
+        return self.file_tree(info, depth_infinity)
+
+    def list_deep(self, path, num_workers: int = 1, cached: Dict[str, FileInfo] = None):
+        # breadth-first crawl. Each directory is listed by a Depth: 1 PROPFIND; up to num_workers PROPFINDs are in flight.
+        # The subtree of a directory with the same etag as a cached one is taken from the cache
+        info = []
+        children = cached_children(cached)
+        def descend(fileinfo) -> bool:
+            if not fileinfo.is_dir or self.is_ignored_dir(fileinfo.path):
+                return False
+            cached_dir = None if cached is None else cached.get(fileinfo.path.rstrip("/"), None)
+            if cached_dir is not None and fileinfo.etag is not None and cached_dir.etag == fileinfo.etag:
+                info.extend(cached_subtree(children, fileinfo.path))
+                return False
+            return True
+
+        if num_workers <= 1:
+            dirs = deque([path])
+            while len(dirs) > 0:
+                for fileinfo in self.list_flat(dirs.popleft()):
+                    info.append(fileinfo)
+                    if descend(fileinfo):
+                        dirs.append(quote(fileinfo.path))
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="propfind") as executor:
+                pending = {executor.submit(self.list_flat, path)}
+                while len(pending) > 0:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for fileinfo in future.result():
+                            info.append(fileinfo)
+                            if descend(fileinfo):
+                                pending.add(executor.submit(self.list_flat, quote(fileinfo.path)))
+        return info
+
+    def list_cached(self, num_workers: int = 1):
+        # a tree with an unchanged root collection is taken from the cache. Otherwise the changes are requested by a
+        # sync-collection REPORT, if supported, or the tree is crawled reusing unchanged collections. This requires a
+        # server, which changes the etag (or ctag) of all parent collections on a change (like Nextcloud and ownCloud)
+        token, sync_token = self.collection_tokens("/")
+        cached_token, cached_sync_token = self.listing_cache.tokens()
+        cached = {path.rstrip("/"): FileInfo(self, self.root, path, size, last_modified, is_dir, etag, checksums) for path, size, last_modified, is_dir, etag, checksums in self.listing_cache.entries()}
+        info = None
+        if token is not None and token == cached_token:
+            logging.info(self.address + " is unchanged (" + token + "). Using the cached listing")
+            info = list(cached.values())
+        elif sync_token is not None and cached_sync_token is not None:
+            try:
+                info, sync_token = self.sync_collection(cached_sync_token, cached)
+            except ResponseErrorCode as e:
+                if e.code in self.THROTTLE_CODES:
+                    raise e
+                # e.g. 403 invalid sync token or 507 too many changes
+                logging.info("sync-collection REPORT on " + self.address + " failed (" + str(e.code) + "). Crawling directories")
+        if info is None:
+            info = self.list_deep("/", num_workers, cached)
+        self.listing_cache.replace(token, sync_token, [(fileinfo.path, fileinfo.size, int(fileinfo.last_modified_epoch), fileinfo.is_dir, fileinfo.etag, fileinfo.checksums) for fileinfo in info])
+        return info
+
+    def collection_tokens(self, path):
+        # the change token (ctag, or etag if not supported) and the sync-token of a collection
+        with self.request("PROPFIND", self.root + path, headers={"Depth": "0", "Content-Type": "application/xml"}, data=self.COLLECTION_REQUEST) as r:
+            root = etree.fromstring(r.content)
+        def text_of(tag):
+            text = root.findtext(".//" + tag)
+            return None if text is None or len(text.strip()) == 0 else text.strip()
+        token = text_of("{http://calendarserver.org/ns/}getctag") or text_of("{DAV:}getetag")
+        return token, text_of("{DAV:}sync-token")
+
+    def sync_collection(self, sync_token: str, cached: Dict[str, FileInfo]):
+        # RFC 6578. Returns the cached listing updated by the changes since the sync token, and the new sync token
+        with self.request("REPORT", self.root + "/", headers={"Depth": "0", "Content-Type": "application/xml"},
+                          data=self.SYNC_COLLECTION_REQUEST.format(escape(sync_token)).encode("utf-8")) as r:
+            content = r.content
+        root = etree.fromstring(content)
+        removed = []
+        for response in root.iter("{DAV:}response"):
+            # a removed member is reported by a 404 status of the response (instead of a propstat)
+            status = response.findtext("{DAV:}status")
+            href = response.findtext("{DAV:}href")
+            if status is not None and " 404" in status and href is not None:
+                href = unquote(urlparse(href).path if href.startswith("http") else href)
+                removed.append(href[len(self.root):].rstrip("/"))
+        changed = self.parse_propfind_response("/", content)
+        logging.info(self.address + " - " + str(len(changed)) + " changed and " + str(len(removed)) + " removed entries reported by sync-collection")
+        removed_prefixes = tuple(path + "/" for path in removed)
+        info = {path: fileinfo for path, fileinfo in cached.items() if path not in removed and not (len(removed_prefixes) > 0 and path.startswith(removed_prefixes))}
+        for fileinfo in changed:
+            info[fileinfo.path.rstrip("/")] = fileinfo
+        new_sync_token = root.findtext("{DAV:}sync-token")
+        return list(info.values()), None if new_sync_token is None else new_sync_token.strip()
+
+    def list_infinite(self, path, num_workers: int = 1):
+        # a single Depth: infinity PROPFIND. Many servers refuse it (403 propfind-finite-depth), so fall back to crawling
         try:
-            info = []
-            filepath = None
-            size = None
-            is_dir = None
-            last_modified = None
-            for event, element in etree.iterparse(BytesIO(binary_content)):
-                if element.tag.endswith("href"):
-                    filepath = unquote(element.text)
-                elif element.tag.endswith("iscollection"):
-                    is_dir = element.text == 'true'
-                elif element.tag.endswith("Win32LastModifiedTime"):
-                    last_modified = dateparser.parse(element.text)
-                elif element.tag.endswith("getcontentlength"):
-                    size = int(element.text)
-
-                elif element.tag.endswith("response"):
-                    if filepath is not None and size is not None and is_dir is not None and last_modified is not None:
-                        rel_path = filepath[len(self.root):]
-                        if rel_path != path and rel_path != unquote(path):
-                            info.append(FileInfo(self, self.root, rel_path, size, last_modified, is_dir))
-                    filepath = None
-                    size = None
-                    is_dir = None
-                    last_modified = None
-            return info
-        except Exception as e:
-            print(e)
-            raise e
+            return self.list_flat(path, depth="infinity")
+        except ResponseErrorCode as e:
+            logging.info("Depth: infinity PROPFIND not supported by " + self.address + " (" + str(e.code) + "). Crawling directories")
+            return self.list_deep(path, num_workers)
+
+    def list_flat(self, path, depth: str = "1"):
+        with self.request("PROPFIND", self.root + unquote(path),
+                          headers={"Depth": depth, "Content-Type": "application/xml"},
+                          data=self.PROPFIND_REQUEST,
+                          stream=True) as r:
+            try:
+                return self.parse_propfind_response(path, r.iter_content(chunk_size=64 * 1024))
+            except Exception as e:
+                logging.error("Error occurred by parsing propfind response of " + self.address + path + " " + str(e))
+                raise e
 
+    def scan_dir(self, path: str):
+        # returns the files and the sub dirs of a dir (relative to the root, without trailing slash) like the local provider
+        files = []
+        subdirs = []
+        listing = self.list_flat(quote(path + "/"))
+        # listed, so the dir exists
+        self.known_dirs.add((self.root + path).rstrip("/"))
+        for fileinfo in listing:
+            if not fileinfo.is_dir:
+                files.append(fileinfo)
+            elif not self.is_ignored_dir(fileinfo.path):
+                subdirs.append(fileinfo.path.rstrip("/"))
+                self.known_dirs.add((self.root + fileinfo.path).rstrip("/"))
+        return files, subdirs
 
     def read(self, filepath, local_target, last_modified_epoch):
-        temp_file = self.tempfile_name(local_target)
+        # the temp file is named by the last modified time of the remote file. A failed download of the same
+        # file version leaves it behind, so the next attempt resumes it by a range request
+        temp_file = self.tempfile_name(local_target, suffix='part', id=str(int(last_modified_epoch)))
         self.make_parents(temp_file)
         remote_path = self.root + filepath
         try:
+            self.download(remote_path, temp_file)
+        except Exception as e:
+            logging.warning("error occurred downloading " + remote_path + " " + str(e))
+            raise e
+        os.replace(temp_file, local_target)
+        os.utime(local_target, (last_modified_epoch, last_modified_epoch))
+        self.delete_partial_files(local_target)
+
+    def download(self, remote_path, local_file):
+        offset = os.path.getsize(local_file) if os.path.exists(local_file) else 0
+        headers = {"Range": "bytes=" + str(offset) + "-"} if offset > 0 else {}
+        with self.request("GET", remote_path, headers=headers, stream=True, accepted_codes=[416]) as r:
+            if r.status_code == 416:
+                # range not satisfiable. The partial file does not match the remote file
+                logging.info("partial file " + local_file + " outdated. Restarting download")
+                self.delete_file(local_file)
+                return self.download(remote_path, local_file)
+            if r.status_code == 206:
+                logging.info("resuming download of " + remote_path + " at " + human_readable_size(offset))
+                mode = "ab"
+            else:
+                mode = "wb"
+            with open(local_file, mode) as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    self.throttle(len(chunk))
+
+    def delete_partial_files(self, local_target):
+        # partial downloads of outdated file versions
+        idx = local_target.rindex('/')
+        for partial_file in glob.glob(glob.escape(local_target[:idx]) + "/" + WebDavStoreProvider.TEMP_PREFIX + "*_part_" + glob.escape(local_target[idx+1:])):
+            self.delete_file(partial_file)
+
+    def write(self, local_source, webdav_target, last_modified_epoch):
+        is_delta = self.signatures is not None and os.path.getsize(local_source) >= self.DELTA_MIN_SIZE
+        if is_delta and self.write_delta(local_source, webdav_target, last_modified_epoch):
+            return
+        if self.resumable_uploads and self.partial_updates:
+            self.store(webdav_target, last_modified_epoch, lambda remote_path: self.upload_chunked(local_source, remote_path), resumable=True)
+        else:
+            self.store(webdav_target, last_modified_epoch, lambda remote_path: self.upload(local_source, remote_path))
+        if is_delta:
+            self.store_signatures(self.root + webdav_target, os.path.getsize(local_source), self.chunk_size, block_signatures(local_source, self.chunk_size))
+
+    def write_delta(self, local_source, webdav_target, last_modified_epoch) -> bool:
+        # uploads the changed blocks only, and returns False if a full upload is required. The block signatures of the
+        # remote file are known by the last upload. Changed blocks are written by the SabreDAV partial update extension
+        # to a server-side copy of the remote file, which then replaces it
+        remote_path = self.root + webdav_target
+        known = self.signatures.get(self.url(remote_path))
+        if known is None or not self.partial_updates:
+            return False
+        size, etag, block_size, remote_signatures = known
+        r = self.request("HEAD", remote_path, accepted_codes=[404])
+        if r.status_code == 404 or int(r.headers.get("Content-Length", -1)) != size or r.headers.get("ETag", None) != etag:
+            # modified by others since the last upload
+            return False
+        local_size = os.path.getsize(local_source)
+        if local_size < size:
+            # a partial update can not truncate the file
+            return False
+        signatures = block_signatures(local_source, block_size)
+        changed = [i for i, signature in enumerate(signatures) if i >= len(remote_signatures) or signature != remote_signatures[i]]
+        if min(len(changed) * block_size, local_size) > local_size * self.DELTA_MAX_CHANGED:
+            return False
+
+        logging.info("delta upload of " + remote_path + " (" + str(len(changed)) + " of " + str(len(signatures)) + " blocks changed)")
+        time = self.http_date(last_modified_epoch)
+        if len(changed) == 0:
+            # same content. Just the last modified time is updated
+            self.set_last_modified(remote_path, time)
+            self.store_signatures(remote_path, local_size, block_size, signatures)
+            return True
+        webdav_temp_file = self.tempfile_name(remote_path)
+        try:
+            self.copy(remote_path, webdav_temp_file)
+            with open(local_source, "rb") as f:
+                for i in changed:
+                    f.seek(i * block_size)
+                    block = f.read(block_size)
+                    self.throttle(len(block))
+                    self.request("PATCH", webdav_temp_file, data=block, headers={"Content-Type": "application/x-sabredav-partialupdate",
+                                                                                "X-Update-Range": "bytes=" + str(i * block_size) + "-" + str(i * block_size + len(block) - 1)})
+            self.move(webdav_temp_file, remote_path)
+            self.set_last_modified(remote_path, time)
+        except ResponseErrorCode as e:
+            self.delete(webdav_temp_file)
+            if e.code in self.THROTTLE_CODES:
+                raise e
+            if e.code in self.UNSUPPORTED_CODES:
+                self.partial_updates = False
+            logging.info("delta upload of " + remote_path + " failed (" + str(e.code) + "). Uploading the full file")
+            return False
+        self.store_signatures(remote_path, local_size, block_size, signatures)
+        return True
+
+    def store_signatures(self, remote_path, size: int, block_size: int, signatures: List[str]):
+        # the etag identifies the uploaded version. Without an etag, changes by others could not be detected
+        etag = self.request("HEAD", remote_path).headers.get("ETag", None)
+        if etag is None:
+            self.signatures.remove(self.url(remote_path))
+        else:
+            self.signatures.put(self.url(remote_path), size, etag, block_size, signatures)
+
+    def copy_from(self, source_provider, source_path, webdav_target, last_modified_epoch):
+        if source_provider.host == self.host and source_provider.username == self.username:
+            # same server and account. The server copies the file, no data is transferred
+            remote_path = self.root + webdav_target
             try:
-                self.client.download_sync(remote_path=remote_path, local_path=temp_file)
+                self.make_webdav_parents(remote_path)
+                self.copy(source_provider.root + source_path, remote_path)
+                self.set_last_modified(remote_path, self.http_date(last_modified_epoch))
             except Exception as e:
-                logging.warning("error occurred downloading " + remote_path, e)
+                logging.warning("error occurred copying " + source_provider.root + source_path + " to " + remote_path + " " + str(e))
                 raise e
-            os.replace(temp_file, local_target)
-            os.utime(local_target, (last_modified_epoch, last_modified_epoch))
-        finally:
-            self.delete_file(temp_file)
+        else:
+            # the download is streamed into the upload. Nothing is buffered on disk
+            self.store(webdav_target, last_modified_epoch, lambda remote_path: self.upload_from(source_provider, source_path, remote_path))
 
-    def write(self, local_source, webdav_target, last_modified_epoch):
+    def store(self, webdav_target, last_modified_epoch, upload, resumable: bool = False):
+        # upload is called with the remote path to upload to
         remote_path = self.root + webdav_target
-        webdav_temp_file = self.tempfile_name(remote_path)
+        time = self.http_date(last_modified_epoch)
+        if self.direct_upload:
+            # PUT and PROPPATCH only. Not atomic: a failed upload leaves an incomplete file, which is replaced by the next sync
+            try:
+                self.make_webdav_parents(remote_path)
+                upload(remote_path)
+                self.set_last_modified(remote_path, time)
+            except Exception as e:
+                logging.warning("error occurred uploading " + remote_path + " " + str(e))
+                raise e
+            return
+
+        if resumable:
+            webdav_temp_file = self.tempfile_name(remote_path, suffix='part', id=str(int(last_modified_epoch)))
+        else:
+            webdav_temp_file = self.tempfile_name(remote_path)
         try:
-            # upload local file as tempfile
+            # upload file as tempfile
             self.make_webdav_parents(webdav_temp_file)
-            time = datetime.fromtimestamp(last_modified_epoch, tz=timezone('UTC')).strftime("%a, %d %b %Y %H:%M:%S %Z")
-            self.client.upload(remote_path=webdav_temp_file, local_path=local_source)
+            upload(webdav_temp_file)
 
             # rename uploaded temp file to target file
-            self.client.move(remote_path_from=webdav_temp_file, remote_path_to=remote_path)
+            self.move(webdav_temp_file, remote_path)
 
-            self.client.set_property(remote_path, {'namespace': 'urn:schemas-microsoft-com:',
-                                                   'name': 'Win32LastModifiedTime',
-                                                   'value': time})
+            self.set_last_modified(remote_path, time)
         except Exception as e:
-            logging.warning("error occurred uploading " + remote_path, e)
+            logging.warning("error occurred uploading " + remote_path + " " + str(e))
+            # a resumable temp file is kept to continue the upload next time. After a successful move, there is nothing to delete
+            if not resumable:
+                self.delete(webdav_temp_file)
             raise e
-        finally:
-            self.delete(webdav_temp_file)
-
-    def delete_file(self, file):
-        if os.path.exists(file):
-            os.remove(file)
-
-    def tempfile_name(self, filenname: str, suffix: str='temp'):
-        idx = filenname.rindex('/')
-        temp_file = filenname[:idx] + "/" + WebDavStoreProvider.TEMP_PREFIX + str(uuid.uuid1()) + "_" + suffix + "_" + filenname[idx+1:]
-        return temp_file
-
-    def make_parents(self, filepath):
-        parent = filepath[:filepath.rindex('/')]
-        if not os.path.exists(parent):
+        if resumable:
+            self.delete_partial_uploads(webdav_target)
+
+    def delete_partial_uploads(self, webdav_target):
+        # partial uploads of outdated file versions (named by another last modified time). Like partial downloads,
+        # they would be kept forever otherwise, hidden by the ignore pattern of temp files
+        idx = webdav_target.rindex('/')
+        suffix = "_part_" + webdav_target[idx+1:]
+        try:
+            for fileinfo in self.list_flat(quote(webdav_target[:idx] + "/")):
+                filename = fileinfo.path.rstrip("/").split("/")[-1]
+                if not fileinfo.is_dir and filename.startswith(WebDavStoreProvider.TEMP_PREFIX) and filename.endswith(suffix):
+                    logging.info("deleting outdated partial upload " + self.root + fileinfo.path)
+                    self.request("DELETE", self.root + fileinfo.path, accepted_codes=[404])
+        except Exception as e:
+            logging.warning("could not delete partial uploads of " + self.root + webdav_target + " " + str(e))
+
+    def upload(self, local_source, remote_path):
+        # the file object is streamed by requests. Memory usage does not depend on the file size
+        with open(local_source, "rb") as f:
+            # requests would send an empty file object chunked. Not all servers support that
+            size = os.path.getsize(local_source)
+            self.request("PUT", remote_path, data=self.throttled(f, size) if size > 0 else b"")
+
+    def upload_from(self, source_provider, source_path, remote_path):
+        # identity encoding: the content length of the download is the size of the upload. A download without
+        # content length (chunked) or encoded anyway is decoded and uploaded chunked
+        with source_provider.request("GET", source_provider.root + source_path, headers={"Accept-Encoding": "identity"}, stream=True) as r:
+            length = r.headers.get("Content-Length", None)
+            if length is None or r.headers.get("Content-Encoding", "identity").lower() != "identity":
+                self.request("PUT", remote_path, data=self.throttled_chunks(r))
+            else:
+                size = int(length)
+                self.request("PUT", remote_path, data=self.throttled(ResponseStream(r, size), size) if size > 0 else b"")
+
+    def throttled_chunks(self, response):
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            self.throttle(len(chunk))
+            yield chunk
+
+    def upload_chunked(self, local_source, remote_path):
+        # uploads chunk by chunk. The first chunk is PUT, the remaining ones are appended by PATCH requests of the
+        # SabreDAV partial update extension. An existing temp file of a failed upload is continued
+        size = os.path.getsize(local_source)
+        offset = self.remote_size(remote_path)
+        if offset > size:
+            self.delete(remote_path)
+            offset = 0
+        if offset > 0:
+            logging.info("resuming upload of " + remote_path + " at " + human_readable_size(offset))
+        with open(local_source, "rb") as f:
+            f.seek(offset)
+            if offset == 0:
+                chunk = f.read(self.chunk_size)
+                self.throttle(len(chunk))
+                self.request("PUT", remote_path, data=chunk)
+                offset = offset + len(chunk)
+            while offset < size:
+                chunk = f.read(self.chunk_size)
+                self.throttle(len(chunk))
+                try:
+                    self.request("PATCH", remote_path, data=chunk, headers={"Content-Type": "application/x-sabredav-partialupdate",
+                                                                            "X-Update-Range": "bytes=" + str(offset) + "-" + str(offset + len(chunk) - 1)})
+                except ResponseErrorCode as e:
+                    if e.code not in self.UNSUPPORTED_CODES:
+                        raise e
+                    # the server has no partial updates. This and all further files are uploaded by a single PUT
+                    logging.warning("partial updates rejected by " + self.host + " (" + str(e.code) + "). Uploading full files")
+                    self.partial_updates = False
+                    self.upload(local_source, remote_path)
+                    return
+                offset = offset + len(chunk)
+
+    def throttle(self, num_bytes: int):
+        if self.bandwidth is not None:
+            self.bandwidth.consume(num_bytes)
+
+    def throttled(self, file, size: int):
+        # a request body limited by the bandwidth cap
+        return file if self.bandwidth is None else ThrottledReader(file, self.bandwidth, size)
+
+    def remote_size(self, remote_path) -> int:
+        r = self.request("HEAD", remote_path, accepted_codes=[404])
+        if r.status_code == 404:
+            return 0
+        return int(r.headers.get("Content-Length", 0))
+
+    def request(self, method: str, remote_path: str, headers: Dict[str, str] = None, accepted_codes: List[int] = list(), **kwargs):
+        # error codes are raised as ResponseErrorCode, like the webdav client does. So 429 is handled the same way
+        # Throttled requests are retried, as long as the body can be sent again (not a streamed file)
+        data = kwargs.get("data", None)
+        max_retries = self.MAX_RETRIES if data is None or isinstance(data, (bytes, str)) else 0
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            start = time.time()
             try:
-                os.makedirs(parent)
-                logging.info("directory " + parent + " created")
+                r = self.session.request(method=method,
+                                         url=self.url(remote_path),
+                                         headers=headers,
+                                         **kwargs)
             except Exception as e:
-                logging.warning("could not create parent directory " + parent)
+                self.limiter.release()
                 raise e
+            if self.metrics is not None:
+                # time to the response header. The body of a streamed response is not included
+                self.metrics.observe_request(self.host.split("://")[-1], method, time.time() - start, r.status_code)
+            throttled = r.status_code in self.THROTTLE_CODES
+            self.limiter.release(throttled, retry_after_sec(r.headers.get("Retry-After", None)) if throttled else None)
+            if r.status_code >= 400 and r.status_code not in accepted_codes:
+                r.close()
+                if throttled and attempt < max_retries:
+                    attempt = attempt + 1
+                    logging.debug(method + " " + remote_path + " throttled (" + str(r.status_code) + "). Retry " + str(attempt))
+                    continue
+                raise ResponseErrorCode(r.url, r.status_code, r.reason)
+            return r
+
+    def exists(self, remote_path) -> bool:
+        try:
+            return self.request("HEAD", remote_path).status_code == 200
+        except ResponseErrorCode:
+            return False
+
+    def mkdir(self, remote_path):
+        # 405: directory exists already
+        self.request("MKCOL", remote_path.rstrip("/") + "/", accepted_codes=[405])
+
+    def move(self, remote_path_from, remote_path_to):
+        self.request("MOVE", remote_path_from, headers={"Destination": self.url(remote_path_to), "Overwrite": "T"})
+
+    def copy(self, remote_path_from, remote_path_to):
+        self.request("COPY", remote_path_from, headers={"Destination": self.url(remote_path_to), "Overwrite": "T"})
+
+    def set_last_modified(self, remote_path, time: str):
+        self.request("PROPPATCH", remote_path, headers={"Content-Type": "application/xml"}, data=self.PROPPATCH_REQUEST.format(time).encode("utf-8"))
 
     def make_webdav_parents(self, filepath, max_depth=100):
         parent = filepath[:filepath.rindex('/')]
+        if parent in self.known_dirs:
+            return
         if max_depth > 0:
-            if not self.client.check(parent):
+            if not self.exists(parent):
                 self.make_webdav_parents(parent, max_depth - 1)
-                self.client.mkdir(parent)
+                self.mkdir(parent)
                 logging.info("webdav dir " + parent + " created")
+            self.known_dirs.add(parent)
         else:
             logging.info("max depth of folder creation reached")
 
     def delete(self, webdav_file):
-        if self.client.check(webdav_file):
-            self.client.clean(webdav_file)
+        if self.exists(webdav_file):
+            self.request("DELETE", webdav_file)
+
+    def remove(self, path: str):
+        # 404: deleted already
+        self.request("DELETE", self.root + path, accepted_codes=[404])
+
+    def rename(self, path: str, new_path: str):
+        self.move(self.root + path, self.root + new_path)
+
+    def flush(self):
+        # writes buffered by the provider. Nothing is buffered by default
+        pass
+
+    def is_buffered(self, path: str) -> bool:
+        # True, if a written file is not stored until the next (successful) flush
+        return False
+
+
+
+class PackSegment:
+    """
+    zip archive of small files, built in memory and uploaded as a whole
+    """
+
+    def __init__(self):
+        self.name = str(uuid.uuid1()) + ".zip"
+        self.buffer = io.BytesIO()
+        self.archive = zipfile.ZipFile(self.buffer, "w", zipfile.ZIP_DEFLATED)
+        self.entries = {}   # logical path -> index entry
+        self.size = 0
+
+    def add(self, path: str, data: bytes, last_modified_epoch):
+        member = path.lstrip("/")
+        self.archive.writestr(member, data)
+        self.entries[path] = {"segment": self.name, "member": member, "size": len(data), "mtime": int(last_modified_epoch)}
+        self.size += len(data)
+
+    def close(self) -> bytes:
+        self.archive.close()
+        return self.buffer.getvalue()
+
+
+
+class PackedWebDavStoreProvider(WebDavStoreProvider):
+    """
+    webdav provider storing files smaller than pack_size in zip segments (many files per upload) and, with compress,
+    files of compressible types gzipped. Both are described by an index (<root>/.filesync/index.json.gz), which maps
+    the logical path to the segment or compressed file. info_tree and scan_dir return the logical files
+    """
+
+    PACK_DIR = "/.filesync"
+    INDEX_FILE = PACK_DIR + "/index.json.gz"
+    SEGMENT_SIZE = 8 * 1024 * 1024
+    COMPRESSED_SUFFIX = ".filesync.gz"
+    COMPRESS_TYPES = (".txt", ".log", ".csv", ".tsv", ".json", ".xml", ".html", ".htm", ".md", ".yml", ".yaml", ".sql", ".svg")
+
+    def __init__(self, address, chunk_size: int = WebDavStoreProvider.DEFAULT_CHUNK_SIZE, resumable_uploads: bool = False, pool_size: int = WebDavStoreProvider.DEFAULT_POOL_SIZE,
+                 direct_upload: bool = False, max_requests_per_sec: float = 0, pack_size: int = 0, compress: bool = False):
+        super().__init__(address, chunk_size, resumable_uploads, pool_size, direct_upload, max_requests_per_sec)
+        self.pack_size = pack_size
+        self.compress = compress
+        self.index = None   # logical path -> entry. Loaded on first use
+        self.segments = []
+        self.real_files = set()   # listed files, which are replaced by a packed or compressed one on write
+        self.__lock = threading.Lock()
+        self.__segment = None   # segment being filled
+        self.__dirty = False
+        self.__unstored = set()   # packed files, which segment has not been uploaded
+        self.__unindexed = set()   # packed or compressed files, which are not in the stored index yet
+        self.__listing = None
+        self.__cache_lock = threading.Lock()
+        self.__cache_dir = None
+        self.__cached_segments = {}
+
+    def is_ignored_dir(self, path: str) -> bool:
+        return path.rstrip("/") == self.PACK_DIR or super().is_ignored_dir(path)
+
+    def load_index(self) -> Dict[str, Dict[str, Any]]:
+        with self.__lock:
+            if self.index is None:
+                # identity: servers may serve .gz files with Content-Encoding gzip
+                r = self.request("GET", self.root + self.INDEX_FILE, headers={"Accept-Encoding": "identity"}, accepted_codes=[404])
+                if r.status_code == 404:
+                    self.index, self.segments = {}, []
+                else:
+                    index = json.loads(gzip.decompress(r.content).decode("utf-8"))
+                    self.index, self.segments = index["files"], index["segments"]
+                    logging.info("pack index of " + self.address + " loaded (" + str(len(self.index)) + " files, " + str(len(self.segments)) + " segments)")
+            return self.index
+
+    def info_tree(self, ignore_subdirs: bool=False, num_workers: int = 1, depth_infinity: bool = False):
+        index = self.load_index()
+        stored = {entry["stored"] for entry in index.values() if "stored" in entry}
+        files = {path: fileinfo for path, fileinfo in super().info_tree(ignore_subdirs, num_workers, depth_infinity).items()
+                 if path not in stored and not path.startswith(self.PACK_DIR + "/")}
+        with self.__lock:
+            self.real_files.update(files.keys())
+        for path, entry in index.items():
+            if not ignore_subdirs or path.count("/") == 1:
+                files[path] = self.file_info(path, entry["size"], entry["mtime"])
+        return files
+
+    def scan_dir(self, path: str):
+        try:
+            files, subdirs = super().scan_dir(path)
+        except ResponseErrorCode as e:
+            # a dir of packed files only does not exist on the server
+            if e.code != 404:
+                raise e
+            files, subdirs = [], []
+        stored, dir_files, dir_subdirs = self.index_listing()
+        logical_files = dir_files.get(path, [])
+        logical_paths = {fileinfo.path for fileinfo in logical_files}
+        files = [fileinfo for fileinfo in files if fileinfo.path not in stored and fileinfo.path not in logical_paths]
+        with self.__lock:
+            self.real_files.update(fileinfo.path for fileinfo in files)
+        return files + logical_files, sorted(set(subdirs) | {subdir for subdir in dir_subdirs.get(path, set()) if not self.is_ignored_dir(subdir)})
+
+    def index_listing(self):
+        # the logical files and dirs of the index per dir, as of the first scan. Writes of the running sync do not change it
+        index = self.load_index()
+        with self.__lock:
+            if self.__listing is None:
+                stored = set()
+                dir_files = {}
+                dir_subdirs = {}
+                for path, entry in index.items():
+                    if "stored" in entry:
+                        stored.add(entry["stored"])
+                    parent = path[:path.rindex("/")]
+                    dir_files.setdefault(parent, []).append(self.file_info(path, entry["size"], entry["mtime"]))
+                    while len(parent) > 0:
+                        dir_subdirs.setdefault(parent[:parent.rindex("/")], set()).add(parent)
+                        parent = parent[:parent.rindex("/")]
+                self.__listing = stored, dir_files, dir_subdirs
+            return self.__listing
+
+    def write(self, local_source, webdav_target, last_modified_epoch):
+        size = os.path.getsize(local_source)
+        if size < self.pack_size:
+            self.pack(local_source, webdav_target, last_modified_epoch)
+        elif self.compress and webdav_target.lower().endswith(self.COMPRESS_TYPES):
+            self.write_compressed(local_source, webdav_target, size, last_modified_epoch)
+        else:
+            super().write(local_source, webdav_target, last_modified_epoch)
+            self.set_entry(webdav_target, None)
+
+    def pack(self, local_source, webdav_target, last_modified_epoch):
+        # the file is uploaded with the segment, when the segment is full or flushed
+        with open(local_source, "rb") as f:
+            data = f.read()
+        full_segment = None
+        with self.__lock:
+            if self.__segment is None:
+                self.__segment = PackSegment()
+            self.__segment.add(webdav_target, data, last_modified_epoch)
+            self.__unstored.add(webdav_target)
+            if self.__segment.size >= self.SEGMENT_SIZE:
+                full_segment, self.__segment = self.__segment, None
+        if full_segment is not None:
+            self.upload_segment(full_segment)
+
+    def upload_segment(self, segment: PackSegment):
+        data = segment.close()
+        logging.info("uploading segment " + segment.name + " (" + str(len(segment.entries)) + " files, " + human_readable_size(len(data)) + ")")
+        self.load_index()
+        self.throttle(len(data))
+        self.store(self.PACK_DIR + "/packs/" + segment.name, time.time(), lambda remote_path: self.request("PUT", remote_path, data=data))
+        with self.__lock:
+            self.segments.append(segment.name)
+            self.__unstored.difference_update(segment.entries.keys())
+        for path, entry in segment.entries.items():
+            self.set_entry(path, entry)
+
+    def write_compressed(self, local_source, webdav_target, size: int, last_modified_epoch):
+        stored = webdav_target + self.COMPRESSED_SUFFIX
+        fd, temp_file = tempfile.mkstemp(suffix=".gz")
+        try:
+            with os.fdopen(fd, "wb") as out, open(local_source, "rb") as f:
+                with gzip.GzipFile(filename="", fileobj=out, mode="wb", mtime=int(last_modified_epoch)) as compressed:
+                    shutil.copyfileobj(f, compressed, self.chunk_size)
+            logging.debug(webdav_target + " compressed to " + human_readable_size(os.path.getsize(temp_file)))
+            self.store(stored, last_modified_epoch, lambda remote_path: self.upload(temp_file, remote_path))
+        finally:
+            os.remove(temp_file)
+        self.set_entry(webdav_target, {"stored": stored, "size": size, "mtime": int(last_modified_epoch)})
+
+    def set_entry(self, path: str, entry: Optional[Dict[str, Any]]):
+        # entry None: the file is stored as a plain file (or removed). Replaced files are deleted
+        index = self.load_index()
+        to_delete = []
+        with self.__lock:
+            previous = index.pop(path, None) if entry is None else index.get(path, None)
+            if entry is None:
+                self.__unindexed.discard(path)
+            else:
+                index[path] = entry
+                self.__unindexed.add(path)
+                if path in self.real_files:
+                    self.real_files.discard(path)
+                    to_delete.append(path)
+            if previous is not None and "stored" in previous and previous["stored"] != (None if entry is None else entry.get("stored", None)):
+                to_delete.append(previous["stored"])
+            if entry is not None or previous is not None:
+                self.__dirty = True
+        for stored_path in to_delete:
+            self.request("DELETE", self.root + stored_path, accepted_codes=[404])
+
+    def flush(self):
+        # uploads the segment being filled and the index. Segments without referenced files are deleted afterwards
+        with self.__lock:
+            segment, self.__segment = self.__segment, None
+        if segment is not None:
+            self.upload_segment(segment)
+        with self.__lock:
+            if not self.__dirty:
+                return
+            referenced = {entry["segment"] for entry in self.index.values() if "segment" in entry}
+            unreferenced = [name for name in self.segments if name not in referenced]
+            self.segments = [name for name in self.segments if name in referenced]
+            data = gzip.compress(json.dumps({"files": self.index, "segments": self.segments}).encode("utf-8"))
+            indexed = set(self.__unindexed)
+            self.__dirty = False
+        try:
+            self.store(self.INDEX_FILE, time.time(), lambda remote_path: self.request("PUT", remote_path, data=data))
+        except Exception as e:
+            with self.__lock:
+                self.__dirty = True
+            raise e
+        with self.__lock:
+            self.__unindexed.difference_update(indexed)
+        logging.info("pack index of " + self.address + " stored (" + str(len(self.index)) + " files, " + str(len(self.segments)) + " segments)")
+        for name in unreferenced:
+            self.request("DELETE", self.root + self.PACK_DIR + "/packs/" + name, accepted_codes=[404])
+
+    def is_buffered(self, path: str) -> bool:
+        with self.__lock:
+            return path in self.__unstored or path in self.__unindexed
 
-def storeprovider(address):
-    if address.startswith("http"):
-        return WebDavStoreProvider(address)
+    def read(self, filepath, local_target, last_modified_epoch):
+        entry = self.load_index().get(filepath, None)
+        if entry is None:
+            return super().read(filepath, local_target, last_modified_epoch)
+        temp_file = self.tempfile_name(local_target)
+        self.make_parents(temp_file)
+        try:
+            with open(temp_file, "wb") as f:
+                if "segment" in entry:
+                    with zipfile.ZipFile(self.cached_segment(entry["segment"])) as archive:
+                        f.write(archive.read(entry["member"]))
+                else:
+                    with self.request("GET", self.root + entry["stored"], headers={"Accept-Encoding": "identity"}, stream=True) as r:
+                        with gzip.GzipFile(fileobj=r.raw) as compressed:
+                            shutil.copyfileobj(compressed, f, self.chunk_size)
+            os.replace(temp_file, local_target)
+            os.utime(local_target, (last_modified_epoch, last_modified_epoch))
+        except Exception as e:
+            logging.warning("error occurred extracting " + filepath + " " + str(e))
+            self.delete_file(temp_file)
+            raise e
+
+    def cached_segment(self, name: str) -> str:
+        # a segment is downloaded once per sync. The temp dir is removed with the provider
+        with self.__cache_lock:
+            local_file = self.__cached_segments.get(name, None)
+            if local_file is None:
+                if self.__cache_dir is None:
+                    self.__cache_dir = tempfile.TemporaryDirectory(prefix="filesync_")
+                local_file = os.path.join(self.__cache_dir.name, name)
+                with self.request("GET", self.root + self.PACK_DIR + "/packs/" + name, headers={"Accept-Encoding": "identity"}, stream=True) as r:
+                    with open(local_file, "wb") as f:
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                            self.throttle(len(chunk))
+                self.__cached_segments[name] = local_file
+            return local_file
+
+    def copy_from(self, source_provider, source_path, webdav_target, last_modified_epoch):
+        # packed or compressed files are copied by a local temp file
+        source_entry = source_provider.load_index().get(source_path, None) if isinstance(source_provider, PackedWebDavStoreProvider) else None
+        if source_entry is not None or self.pack_size > 0 or self.compress:
+            with tempfile.TemporaryDirectory(prefix="filesync_") as temp_dir:
+                local_file = temp_dir + "/" + source_path.split("/")[-1]
+                source_provider.read(source_path, local_file, last_modified_epoch)
+                self.write(local_file, webdav_target, last_modified_epoch)
+        else:
+            super().copy_from(source_provider, source_path, webdav_target, last_modified_epoch)
+            self.set_entry(webdav_target, None)
+
+    def remove(self, path: str):
+        if path in self.load_index().keys():
+            self.set_entry(path, None)
+        else:
+            super().remove(path)
+
+    def rename(self, path: str, new_path: str):
+        index = self.load_index()
+        with self.__lock:
+            entry = index.pop(path, None)
+            if entry is not None:
+                index[new_path] = entry
+                self.__dirty = True
+        if entry is None:
+            super().rename(path, new_path)
+
+
+def cached_children(cached: Dict[str, FileInfo]) -> Dict[str, List[FileInfo]]:
+    # parent dir path -> cached entries of the dir
+    children = {}
+    if cached is not None:
+        for path, fileinfo in cached.items():
+            children.setdefault(path[:path.rfind("/")], []).append(fileinfo)
+    return children
+
+
+def cached_subtree(children: Dict[str, List[FileInfo]], path: str) -> List[FileInfo]:
+    subtree = []
+    dirs = [path.rstrip("/")]
+    while len(dirs) > 0:
+        for fileinfo in children.get(dirs.pop(), []):
+            subtree.append(fileinfo)
+            if fileinfo.is_dir:
+                dirs.append(fileinfo.path.rstrip("/"))
+    return subtree
+
+
+def storeprovider(address, chunk_size: int = WebDavStoreProvider.DEFAULT_CHUNK_SIZE, resumable_uploads: bool = False, pool_size: int = WebDavStoreProvider.DEFAULT_POOL_SIZE, direct_upload: bool = False, max_requests_per_sec: float = 0,
+                  pack_size: int = 0, compress: bool = False):
+    if address.startswith("http") and (pack_size > 0 or compress):
+        return PackedWebDavStoreProvider(address, chunk_size, resumable_uploads, pool_size, direct_upload, max_requests_per_sec, pack_size, compress)
+    elif address.startswith("http"):
+        return WebDavStoreProvider(address, chunk_size, resumable_uploads, pool_size, direct_upload, max_requests_per_sec)
     else:
         return FileStoreProvider(address)
 
@@ -275,11 +1277,233 @@ def parse_url(url):
     return parts.scheme + '://' + host, parts.path, username, password
 
 
+HTTP_DATE_MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6, "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+def parse_date(text: str):
+    # returns the epoch of a RFC 1123 or ISO 8601 date. Other formats are parsed by dateparser, which is much slower
+    text = text.strip()
+    try:
+        parts = text.split()
+        if len(parts) == 6 and parts[0].endswith(",") and parts[5] in ("GMT", "UTC", "+0000"):
+            # e.g. Sun, 06 Nov 1994 08:49:37 GMT
+            hour, minute, second = parts[4].split(":")
+            return calendar.timegm((int(parts[3]), HTTP_DATE_MONTHS[parts[2]], int(parts[1]), int(hour), int(minute), int(second)))
+        elif len(text) >= 19 and text[4] == "-" and text[10] in ("T", " "):
+            # e.g. 1994-11-06T08:49:37Z
+            parsed = datetime.fromisoformat(text.replace("Z", "+00:00"))
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone('UTC'))
+            return parsed.timestamp()
+    except (ValueError, KeyError):
+        pass
+    parsed = dateparser.parse(text)
+    return None if parsed is None else parsed.timestamp()
+
+
 def compute_hash(files):
     hash = 0
-    for filepath in sorted(files.keys()):
-        hash = hash ^ files[filepath].hashcode()
-    return str(len(files.values())) + "_" + str(hash)
+    for fileinfo in files.values():   # xor is order independent. No need to sort
+        hash = hash ^ fileinfo.hashcode()
+    return str(len(files)) + "_" + str(hash)
+
+
+def manifest_entries(files):
+    return [(file.path, file.size, int(file.last_modified_epoch), file.etag) for file in files]
+
+
+def changed_files(source_file_tree, target_file_tree, ignore_patterns: List[str], ignore_lastmodified: bool = False, ignore_filesize: bool = False, checksum_cache: ChecksumCache = None):
+    # returns the (source file, reason) pairs of new/updated source files. With a checksum cache, files of the
+    # same size are decided by their content, if checksums of both sides are available
+    ignore = IgnoreMatcher(ignore_patterns)
+    changed = []
+    to_verify = []
+    for file in sorted(source_file_tree.keys()):
+        source_file = source_file_tree[file]
+        target_file = target_file_tree.get(file, None)
+
+        is_equals, reason = source_file.is_equals(target_file, ignore_lastmodified, ignore_filesize)
+        if checksum_cache is not None and target_file is not None and source_file.size == target_file.size and (not is_equals or ignore_lastmodified):
+            if ignore.is_ignored(source_file.path):
+                logging.debug("ignore file " + source_file.path)
+            else:
+                to_verify.append((source_file, target_file, is_equals, reason))
+        elif not is_equals:
+            if ignore.is_ignored(source_file.path):
+                logging.debug("ignore file " + source_file.path)
+            else:
+                changed.append((source_file, reason))
+
+    if len(to_verify) > 0:
+        changed = sorted(changed + verify_content(to_verify, checksum_cache), key=lambda change: change[0].path)
+    return changed
+
+
+def info_of_dirs(provider, dirs) -> Dict[str, FileInfo]:
+    # the files directly in the given dirs (relative to the root). A dir which does not exist is empty
+    files = {}
+    for path in sorted(dirs):
+        if provider.type() == "local" and not os.path.isdir(provider.address + path):
+            continue
+        try:
+            dir_files, subdirs = provider.scan_dir(path)
+        except ResponseErrorCode as e:
+            if e.code != 404:
+                raise e
+            continue
+        for fileinfo in dir_files:
+            files[fileinfo.path] = fileinfo
+    return files
+
+
+def merge_join(source_files: List[FileInfo], target_files: List[FileInfo]):
+    # yields (source file, target file or None) pairs of two lists sorted by path
+    i = 0
+    for source_file in source_files:
+        while i < len(target_files) and target_files[i].path < source_file.path:
+            i += 1
+        if i < len(target_files) and target_files[i].path == source_file.path:
+            yield source_file, target_files[i]
+        else:
+            yield source_file, None
+
+
+def pipelined_changes(source, target, ignore_patterns: List[str], ignore_lastmodified: bool = False, ignore_filesize: bool = False,
+                      ignore_subdirs: bool = False, order: TransferOrder = None, scan: Dict[str, Any] = None):
+    # yields the (source file, reason) pairs of new/updated source files directory by directory (depth-first, by path).
+    # A dir is listed on both sides and merge-joined, so only the dirs on the stack are held in memory. A dir missing
+    # on the target is not listed there. scan collects the number of source files, their hash and the scan time
+    ignore = IgnoreMatcher(ignore_patterns)
+    scan = {} if scan is None else scan
+    scan.update({"files": 0, "hash": 0, "sec": 0.0})
+    dirs = [("", True)]   # (dir, exists on target)
+    while len(dirs) > 0:
+        path, on_target = dirs.pop()
+        start = time.time()
+        source_files, source_subdirs = source.scan_dir(path)
+        target_files, target_subdirs = target.scan_dir(path) if on_target else ([], [])
+        scan["sec"] += time.time() - start
+        changed = []
+        for source_file, target_file in merge_join(sorted(source_files, key=lambda file: file.path), sorted(target_files, key=lambda file: file.path)):
+            scan["files"] += 1
+            scan["hash"] ^= source_file.hashcode()
+            is_equals, reason = source_file.is_equals(target_file, ignore_lastmodified, ignore_filesize)
+            if is_equals:
+                pass
+            elif ignore.is_ignored(source_file.path):
+                logging.debug("ignore file " + source_file.path)
+            else:
+                changed.append((source_file, reason))
+        # the transfer order applies within a dir
+        yield from (changed if order is None else order.sort(changed))
+        if not ignore_subdirs:
+            target_subdirs = set(target_subdirs)
+            for subdir in sorted(source_subdirs, reverse=True):
+                dirs.append((subdir, subdir in target_subdirs))
+
+
+def verify_content(to_verify, checksum_cache: ChecksumCache):
+    def remote_checksums_of(fileinfo):
+        return remote_checksums(fileinfo.checksums, fileinfo.etag if fileinfo.provider.etag_md5 else None)
+
+    def checksums_available(fileinfo):
+        return fileinfo.provider.type() == "local" or len(remote_checksums_of(fileinfo)) > 0
+
+    comparable = [(source_file, target_file) for source_file, target_file, is_equals, reason in to_verify if checksums_available(source_file) and checksums_available(target_file)]
+    local_paths = [fileinfo.root + fileinfo.path for pair in comparable for fileinfo in pair if fileinfo.provider.type() == "local"]
+    try:
+        local_checksums = checksum_cache.checksums(local_paths)
+    except Exception as e:
+        logging.warning("error occurred computing checksums " + str(e))
+        local_checksums = {}
+
+    def checksums_of(fileinfo):
+        if fileinfo.provider.type() == "local":
+            return local_checksums.get(fileinfo.root + fileinfo.path, {})
+        else:
+            return remote_checksums_of(fileinfo)
+
+    changed = []
+    for source_file, target_file, is_equals, reason in to_verify:
+        is_same = is_same_content(checksums_of(source_file), checksums_of(target_file))
+        if is_same is None:
+            # content unknown. Fall back to last modified/size
+            if not is_equals:
+                changed.append((source_file, reason))
+        elif is_same:
+            logging.debug("content of " + source_file.path + " is unchanged")
+        else:
+            changed.append((source_file, " REASON: 'checksum of source != checksum of target'"))
+    return changed
+
+
+def is_same_state(fileinfo: FileInfo, entry) -> bool:
+    # entry is a (size, last modified, etag) manifest entry. None means the file does not exist
+    if fileinfo is None or entry is None:
+        return fileinfo is None and entry is None
+    return fileinfo.size == entry[0] and int(fileinfo.last_modified_epoch) == entry[1]
+
+
+def is_in_sync(fileinfo: FileInfo, other: FileInfo) -> bool:
+    return fileinfo.size == other.size and int(fileinfo.last_modified_epoch) == int(other.last_modified_epoch)
+
+
+def conflict_path(path: str) -> str:
+    # e.g. /docs/report (conflict 2024-01-31T10-15-00).pdf
+    idx = path.rfind(".")
+    if idx <= path.rfind("/") + 1:
+        idx = len(path)
+    return path[:idx] + " (conflict " + datetime.now().strftime("%Y-%m-%dT%H-%M-%S") + ")" + path[idx:]
+
+
+def is_below(path: str, dirs: Set[str]) -> bool:
+    # True, if the path is one of the dirs (or files) or below one of them
+    return len(dirs) > 0 and (path in dirs or path.startswith(tuple(dir + "/" for dir in dirs)))
+
+
+def three_way_changes(source_file_tree, target_file_tree, base_source, base_target, ignore_patterns: List[str], unscanned: Set[str] = set()):
+    # compares both sides against the baseline (the state of both sides after the last sync). Returns the uploads and
+    # downloads as (file, reason) pairs, the paths to delete on the source and on the target, and the conflicts as
+    # (winner, loser) pairs. In case of a conflict, the newer file wins. Paths below unscanned dirs are skipped, so
+    # files of an unreadable dir are not taken as deleted
+    ignore = IgnoreMatcher(ignore_patterns)
+    uploads, downloads, source_deletions, target_deletions, conflicts = [], [], [], [], []
+    allow_deletions = True
+    for file_tree, base, address in [(source_file_tree, base_source, "source"), (target_file_tree, base_target, "target")]:
+        if len(file_tree) == 0 and len(base) > 0:
+            # e.g. an unmounted drive. Deleting all files of the other side is most likely wrong
+            logging.warning(address + " is empty, but " + str(len(base)) + " files are known by the last sync. Suppressing deletions")
+            allow_deletions = False
+
+    for path in sorted(set(source_file_tree.keys()) | set(target_file_tree.keys()) | set(base_source.keys()) | set(base_target.keys())):
+        if ignore.is_ignored(path) or is_below(path, unscanned):
+            continue
+        source_file = source_file_tree.get(path, None)
+        target_file = target_file_tree.get(path, None)
+        source_changed = not is_same_state(source_file, base_source.get(path, None))
+        target_changed = not is_same_state(target_file, base_target.get(path, None))
+        if not source_changed and not target_changed:
+            continue
+        if source_changed and not target_changed:
+            if source_file is not None:
+                uploads.append((source_file, "REASON: source changed"))
+            elif target_file is not None and allow_deletions:
+                target_deletions.append(path)
+        elif target_changed and not source_changed:
+            if target_file is not None:
+                downloads.append((target_file, "REASON: target changed"))
+            elif source_file is not None and allow_deletions:
+                source_deletions.append(path)
+        elif source_file is None and target_file is not None:
+            # deleted on the source, modified on the target. The modification wins
+            downloads.append((target_file, "REASON: target changed, source deleted"))
+        elif target_file is None and source_file is not None:
+            uploads.append((source_file, "REASON: source changed, target deleted"))
+        elif source_file is not None and target_file is not None and not is_in_sync(source_file, target_file):
+            if source_file.last_modified_epoch >= target_file.last_modified_epoch:
+                conflicts.append((source_file, target_file))
+            else:
+                conflicts.append((target_file, source_file))
+    return uploads, downloads, source_deletions, target_deletions, conflicts
 
 
 def human_readable_size(size, decimal_places=1):
@@ -291,10 +1515,7 @@ def human_readable_size(size, decimal_places=1):
 
 
 def is_ignored(ignore_patterns, file):
-    for ignore_pattern in ignore_patterns:
-        if fnmatch.fnmatch(file, ignore_pattern):
-            return True
-    return False
+    return IgnoreMatcher(ignore_patterns).is_ignored(file)
 
 def print_elapsed_time(time_sec):
     if time_sec > 60:
@@ -302,6 +1523,289 @@ def print_elapsed_time(time_sec):
     else:
         return "{0:.1f} sec".format(time_sec)
 
+
+class Transfer:
+
+    MAX_ERRORS = 30
+    MAX_RETRIES = 5
+    MAX_PENDING = 10000
+
+    def __init__(self, source, target, progress: Progress = None, simulate: bool = False, num_workers: int = 1, metrics: RunMetrics = None,
+                 order: TransferOrder = None, large_file_size: int = 0, large_file_workers: int = 1):
+        self.source = source
+        self.target = target
+        self.progress = Progress() if progress is None else progress
+        self.simulate = simulate
+        self.num_workers = max(1, num_workers)
+        self.order = order
+        # files of at least large_file_size are copied by their own workers (0 = one lane for all files)
+        self.large_file_size = large_file_size
+        self.large_file_workers = max(1, large_file_workers)
+        self.num_files_copied = 0
+        self.num_errors = 0
+        self.copied_files = []
+        self.metrics = metrics
+        self.__lock = threading.Lock()
+        self.__buffered = []   # copied files, which are stored by the target on flush
+
+    @property
+    def is_aborted(self) -> bool:
+        return self.num_errors > self.MAX_ERRORS
+
+    def run(self, files):
+        # files may be a generator (pipelined sync), which is consumed while files are copied.
+        # Files failed by throttling are requeued with an increased attempt number
+        if self.order is not None:
+            files = self.order.sort(files)
+        if self.large_file_size > 0:
+            # small files are not queued behind large ones. Each lane has its own workers
+            num_small_workers = max(1, self.num_workers - self.large_file_workers)
+            logging.info("small files copied by " + str(num_small_workers) + " worker(s), files larger than " +
+                         human_readable_size(self.large_file_size) + " by " + str(self.large_file_workers) + " worker(s)")
+            with ThreadPoolExecutor(max_workers=num_small_workers, thread_name_prefix="filesync-small") as small_executor, \
+                 ThreadPoolExecutor(max_workers=self.large_file_workers, thread_name_prefix="filesync-large") as large_executor:
+                self.__run_lanes(files, lambda source_file: large_executor if source_file.size >= self.large_file_size else small_executor)
+        elif self.num_workers == 1:
+            num_files = len(files) if isinstance(files, list) else 0
+            retries = deque()
+            for i, (source_file, reason) in enumerate(files):
+                if self.is_aborted:
+                    break
+                self.__set_queue_depth(max(0, num_files - i) + len(retries))
+                if not self.copy(source_file, reason):
+                    retries.append((source_file, reason, 1))
+            while len(retries) > 0 and not self.is_aborted:
+                self.__set_queue_depth(len(retries))
+                source_file, reason, attempt = retries.popleft()
+                if not self.copy(source_file, reason, attempt):
+                    retries.append((source_file, reason, attempt + 1))
+        else:
+            with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="filesync") as executor:
+                self.__run_lanes(files, lambda source_file: executor)
+        self.__set_queue_depth(0)
+        try:
+            # e.g. the last segment of packed files
+            self.target.flush()
+        except Exception as e:
+            self.__add_error()
+            logging.warning("FILECOPY ERROR flushing " + self.target.address + " " + str(e))
+        self.__commit_buffered()
+        if self.is_aborted:
+            logging.warning("to many errors. Stop syncing")
+
+    def __run_lanes(self, files, lane_of):
+        # lane_of returns the executor of a file. A requeued file stays in its lane. At most MAX_PENDING files are
+        # submitted, so a generator of files is not consumed ahead of the copies without bound
+        pending = {}
+        for source_file, reason in files:
+            if self.is_aborted:
+                break
+            executor = lane_of(source_file)
+            pending[executor.submit(self.copy, source_file, reason)] = (executor, source_file, reason, 0)
+            if len(pending) >= self.MAX_PENDING:
+                self.__complete(pending)
+        while len(pending) > 0:
+            self.__complete(pending)
+
+    def __complete(self, pending):
+        self.__set_queue_depth(len(pending))
+        done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            executor, source_file, reason, attempt = pending.pop(future)
+            if not future.result() and not self.is_aborted:
+                pending[executor.submit(self.copy, source_file, reason, attempt + 1)] = (executor, source_file, reason, attempt + 1)
+
+    def __set_queue_depth(self, queue_depth: int):
+        if self.metrics is not None:
+            self.metrics.set_queue_depth(queue_depth)
+
+    def copy(self, source_file: FileInfo, reason: str, attempt: int = 0) -> bool:
+        # returns False, if the copy has been throttled and should be retried
+        if self.is_aborted:
+            return True
+        if attempt > 0:
+            time.sleep(backoff_sec(attempt))
+        try:
+            info = human_readable_size(source_file.size) +", " + source_file.last_modified.strftime("%Y-%m-%dT%H:%M:%S")
+            if self.simulate:
+                logging.info("simulate copying " + self.source.address +  "... to " + self.target.address + source_file.path +  " (" + info + ")  " + reason)
+            else:
+                logging.info("copying " + self.source.address +  "... to " + self.target.address + source_file.path +  " (" + info + ")  " + reason)
+                start = time.time()
+                source_file.copy_to(self.target)
+                elapsed = time.time() - start
+                logging.info("elapsed time " + print_elapsed_time(elapsed) + " (" + source_file.path + ")")
+            with self.__lock:
+                if not self.simulate and self.target.is_buffered(source_file.path):
+                    # counted as copied, once the target has been flushed
+                    self.__buffered.append(source_file)
+                else:
+                    self.__add_copied(source_file)
+                if self.source.type() == 'local':
+                    self.progress.on_uploaded(source_file.filename)
+                else:
+                    self.progress.on_downloaded(source_file.filename)
+        except ResponseErrorCode as re:
+            logging.warning("FILECOPY ERROR copying " + self.source.address + source_file.path + " to " + self.target.address + source_file.path + " Got response error code " + str(re.code))
+            if re.code in WebDavStoreProvider.THROTTLE_CODES and attempt < self.MAX_RETRIES:
+                logging.info("requeuing " + source_file.path + " (retry " + str(attempt + 1) + ")")
+                return False
+            self.__add_error()
+        except Exception as e:
+            self.__add_error()
+            logging.warning("FILECOPY ERROR copying " + self.source.address + source_file.path + " to " + self.target.address + source_file.path + " " + str(e))
+        return True
+
+    def __add_copied(self, source_file: FileInfo):
+        self.num_files_copied = self.num_files_copied + 1
+        if not self.simulate:
+            self.copied_files.append(source_file)
+            if self.metrics is not None:
+                self.metrics.add_transfer(source_file.size)
+
+    def __commit_buffered(self):
+        # buffered files, which are still not stored, are not copied. Their failed segment or index upload is an error already
+        with self.__lock:
+            buffered, self.__buffered = self.__buffered, []
+            unstored = [source_file for source_file in buffered if self.target.is_buffered(source_file.path)]
+            for source_file in buffered:
+                if source_file not in unstored:
+                    self.__add_copied(source_file)
+        if len(unstored) > 0:
+            logging.warning("FILECOPY ERROR " + str(len(unstored)) + " file(s) have not been stored by " + self.target.address + " (" + ", ".join(source_file.path for source_file in unstored[:10]) + ("...)" if len(unstored) > 10 else ")"))
+
+    def __add_error(self):
+        with self.__lock:
+            self.num_errors = self.num_errors + 1
+        if self.metrics is not None:
+            self.metrics.add_error()
+
+
+def sync_bidirectional(source, target, ignore_patterns: List[str], ignore_subdirs: bool = False, progress: Progress = None,
+                       workdir: str = "/etc/sync", simulate: bool = False, num_workers: int = 1, depth_infinity: bool = False,
+                       metrics: RunMetrics = None, order: TransferOrder = None, large_file_size: int = 0, large_file_workers: int = 1):
+    # each side is scanned once. Changes are detected against the baseline stored in the manifest by the last sync
+    try:
+        trees = []
+        for provider in [source, target]:
+            logging.info("scanning " + provider.address + "... ")
+            start = time.time()
+            trees.append(provider.info_tree(ignore_subdirs, num_workers, depth_infinity))
+            elapsed = time.time() - start
+            logging.info(provider.address + " - " + str(len(trees[-1].keys())) + " files found (" + print_elapsed_time(elapsed) + ")")
+            if metrics is not None:
+                metrics.observe_scan(provider.address, elapsed)
+        source_file_tree, target_file_tree = trees
+    except Exception as e:
+        logging.error("Error occurred by scanning " + source.address + " <-> " + target.address + " " + str(e))
+        return 0
+
+    manifest = Manifest(workdir, source.address + "<->" + target.address)
+    base_source = manifest.entries(Manifest.SOURCE)
+    base_target = manifest.entries(Manifest.TARGET)
+    unscanned = source.unscanned | target.unscanned
+    if len(unscanned) > 0:
+        logging.warning(str(len(unscanned)) + " dir(s) or file(s) could not be scanned. Skipping the paths below them (" + ", ".join(sorted(unscanned)[:10]) + ")")
+    uploads, downloads, source_deletions, target_deletions, conflicts = three_way_changes(source_file_tree, target_file_tree, base_source, base_target, ignore_patterns, unscanned)
+
+    # paths below unscanned dirs keep their baseline
+    failed = {path for path in set(base_source.keys()) | set(base_target.keys()) | set(source_file_tree.keys()) | set(target_file_tree.keys()) if is_below(path, unscanned)}
+    for winner, loser in conflicts:
+        # the version of the loser is kept as conflict copy on its side
+        logging.warning("conflict " + winner.path + ": " + winner.provider.address + " version is newer than " + loser.provider.address + " version")
+        if not simulate:
+            try:
+                loser.provider.rename(loser.path, conflict_path(loser.path))
+            except Exception as e:
+                logging.warning("error occurred renaming " + loser.provider.address + loser.path + " " + str(e))
+                failed.add(winner.path)
+                continue
+        if winner.provider is source:
+            uploads.append((winner, "REASON: conflict, source is newer"))
+        else:
+            downloads.append((winner, "REASON: conflict, target is newer"))
+
+    upload = Transfer(source, target, progress, simulate, num_workers, metrics, order, large_file_size, large_file_workers)
+    upload.run(uploads)
+    download = Transfer(target, source, progress, simulate, num_workers, metrics, order, large_file_size, large_file_workers)
+    download.run(downloads)
+    failed.update(file.path for file, reason in uploads + downloads)
+    failed.difference_update(file.path for file in upload.copied_files + download.copied_files)
+
+    deleted = []
+    for provider, paths in [(source, source_deletions), (target, target_deletions)]:
+        for path in paths:
+            logging.info(("simulate deleting " if simulate else "deleting ") + provider.address + path + " REASON: deleted on the other side")
+            if not simulate:
+                try:
+                    provider.remove(path)
+                    deleted.append(path)
+                except Exception as e:
+                    logging.warning("error occurred deleting " + provider.address + path + " " + str(e))
+                    failed.add(path)
+
+    if not simulate:
+        # the new baseline is the state after the sync. Failed paths keep their old baseline, so they are retried next time
+        new_base_source = {path: (size, last_modified, etag) for path, size, last_modified, etag in manifest_entries(source_file_tree.values())}
+        new_base_target = {path: (size, last_modified, etag) for path, size, last_modified, etag in manifest_entries(target_file_tree.values())}
+        for file in upload.copied_files:
+            new_base_target[file.path] = (file.size, int(file.last_modified_epoch), None)
+        for file in download.copied_files:
+            new_base_source[file.path] = (file.size, int(file.last_modified_epoch), None)
+        for path in deleted:
+            new_base_source.pop(path, None)
+            new_base_target.pop(path, None)
+        for base, new_base in [(base_source, new_base_source), (base_target, new_base_target)]:
+            for path in failed:
+                if path in base.keys():
+                    new_base[path] = base[path]
+                else:
+                    new_base.pop(path, None)
+        manifest.replace(Manifest.SOURCE, [(path,) + entry for path, entry in new_base_source.items()])
+        manifest.replace(Manifest.TARGET, [(path,) + entry for path, entry in new_base_target.items()])
+    manifest.close()
+
+    num_files_copied = upload.num_files_copied + download.num_files_copied
+    num_errors = upload.num_errors + download.num_errors
+    if num_errors > 0:
+        logging.info(">> " + str(num_errors) + " errors occurred (imcomplete sync; " + str(num_files_copied) + " file(s) copied, " + str(len(deleted)) + " deleted)")
+    elif num_files_copied > 0 or len(deleted) > 0:
+        logging.info(">> " + str(upload.num_files_copied) + " file(s) uploaded, " + str(download.num_files_copied) + " downloaded, " + str(len(deleted)) + " deleted")
+    else:
+        logging.info(">> no changes")
+    return num_files_copied
+
+
+# guards sync.p, which is shared by all tasks running concurrently
+sync_prop_lock = threading.Lock()
+
+
+def load_hashes(sync_prop_file: str) -> Dict[str, str]:
+    with sync_prop_lock:
+        if os.path.isfile(sync_prop_file):
+            with open(sync_prop_file, "rb") as f:
+                return pickle.load(f)
+        return {}
+
+
+def store_hash(sync_prop_file: str, hash_key: str, hash_code: str):
+    with sync_prop_lock:
+        # re-read the file, so that the entries written by other tasks in the meantime are kept
+        hashes = {}
+        if os.path.isfile(sync_prop_file):
+            try:
+                with open(sync_prop_file, "rb") as f:
+                    hashes = pickle.load(f)
+            except Exception as e:
+                logging.warning("error occurred reading " + sync_prop_file + " " + str(e))
+        hashes[hash_key] = hash_code
+        # written atomically. Readers never see a partially written file
+        temp_file = sync_prop_file + "." + str(os.getpid()) + ".tmp"
+        with open(temp_file, "wb") as f:
+            pickle.dump(hashes, f) # save hashes
+        os.replace(temp_file, sync_prop_file)
+
+
 def sync_folder(source_address: str,
                 target_address: str,
                 ignore_lastmodified: bool=False,
@@ -311,11 +1815,37 @@ def sync_folder(source_address: str,
                 ignore_subdirs: bool=False,
                 progress: Progress = None,
                 workdir: str = "/etc/sync/sync.p",
-                simulate: bool= False):
-    source = storeprovider(source_address)
-    target = storeprovider(target_address)
-
-    sync_prop_file = os.path.join(workdir, "sync.p")
+                simulate: bool= False,
+                num_workers: int = 1,
+                depth_infinity: bool = False,
+                use_manifest: bool = False,
+                changed_paths: List[str] = None,
+                chunk_size: int = WebDavStoreProvider.DEFAULT_CHUNK_SIZE,
+                resumable_uploads: bool = False,
+                pool_size: int = None,
+                direct_upload: bool = False,
+                checksum: bool = False,
+                max_requests_per_sec: float = 0,
+                bidirectional: bool = False,
+                delta_uploads: bool = False,
+                cached_listing: bool = False,
+                transfer_order: str = "path",
+                priority_patterns: List[str] = list(),
+                max_bandwidth: Any = 0,
+                shared_bandwidth: BandwidthLimiter = None,
+                large_file_size: int = 0,
+                large_file_workers: int = 1,
+                pipelined: bool = False,
+                pack_size: int = 0,
+                compress: bool = False,
+                etag_md5: bool = False):
+    # max_bandwidth: bytes per sec (e.g. "2M") or a time of day profile like {"08:00-18:00": "1M", "default": 0}
+    # shared_bandwidth limits this sync together with others (e.g. all tasks of a config)
+    # by default, each worker gets its own connection
+    pool_size = max(WebDavStoreProvider.DEFAULT_POOL_SIZE, num_workers) if pool_size is None else pool_size
+    # a packed webdav side is packed-aware as source as well, so it can be synced back
+    source = storeprovider(source_address, chunk_size, resumable_uploads, pool_size, direct_upload, max_requests_per_sec, pack_size, compress)
+    target = storeprovider(target_address, chunk_size, resumable_uploads, pool_size, direct_upload, max_requests_per_sec, pack_size, compress)
 
     ignore_patterns = ignore_patterns + ['*/' + WebDavStoreProvider.TEMP_PREFIX + '*']
 
@@ -333,103 +1863,216 @@ def sync_folder(source_address: str,
         logging.info("ignoring hash")
     if simulate:
         logging.info("simulate copying")
-    logging.info("scanning source " + source.address + "... ")
+    if num_workers > 1:
+        logging.info("copying with " + str(num_workers) + " workers")
+    if depth_infinity:
+        logging.info("listing webdav trees with Depth: infinity")
+    if use_manifest:
+        logging.info("using manifest")
+    if resumable_uploads:
+        logging.info("resumable uploads (chunk size " + human_readable_size(chunk_size) + ")")
+    elif direct_upload:
+        logging.info("direct uploads")
+    if checksum:
+        logging.info("comparing checksums" + (" (etags taken as md5)" if etag_md5 else ""))
+        for provider in [source, target]:
+            if provider.type() == "webdav":
+                provider.etag_md5 = etag_md5
+    if pack_size > 0:
+        logging.info("packing files smaller than " + human_readable_size(pack_size) + " into segments")
+    if compress:
+        logging.info("compressing files of types " + ", ".join(PackedWebDavStoreProvider.COMPRESS_TYPES))
+    if max_requests_per_sec > 0:
+        logging.info("limiting requests to " + str(max_requests_per_sec) + " per sec and host")
+    # ignored dirs are not scanned at all
+    source.ignore = IgnoreMatcher(ignore_patterns)
+    target.ignore = source.ignore
+    if cached_listing:
+        logging.info("reusing listings of unchanged webdav collections")
+        for provider in [source, target]:
+            if provider.type() == "webdav":
+                # a listing depends on the ignore patterns (pruned dirs)
+                provider.listing_cache = ListingCache(workdir, provider.address + " " + ",".join(sorted(ignore_patterns)))
+    if delta_uploads and target.type() == "webdav":
+        logging.info("delta uploads of files larger than " + human_readable_size(WebDavStoreProvider.DELTA_MIN_SIZE))
+        target.signatures = SignatureStore(workdir)
+    order = TransferOrder(transfer_order, priority_patterns)
+    if transfer_order != "path" or len(priority_patterns) > 0:
+        logging.info("transfer order " + str(order))
+    if max_bandwidth or shared_bandwidth is not None:
+        bandwidth = BandwidthLimiter(max_bandwidth, shared_bandwidth)
+        logging.info("bandwidth limited to " + str(max_bandwidth) + ("" if shared_bandwidth is None else " (shared limit " + str(shared_bandwidth.profile) + ")"))
+        for provider in [source, target]:
+            if provider.type() == "webdav":
+                provider.bandwidth = bandwidth
+    if large_file_size > 0:
+        logging.info("files larger than " + human_readable_size(large_file_size) + " copied by " + str(large_file_workers) + " separate worker(s)")
+
+    metrics = RunMetrics(source.address + "->" + target.address)
+    source.metrics = metrics
+    target.metrics = metrics
+    try:
+        if bidirectional:
+            # the hash and the incremental mode cover one side only. A bidirectional sync always scans both sides
+            if pack_size > 0 or compress:
+                # deletions and conflict copies are not supported for packed or compressed files
+                logging.error("pack_size and compress are not supported by bidirectional syncs")
+                return 0
+            logging.info("bidirectional sync")
+            return sync_bidirectional(source, target, ignore_patterns, ignore_subdirs, progress, workdir, simulate, num_workers, depth_infinity, metrics,
+                                      order, large_file_size, large_file_workers)
+        elif pipelined and changed_paths is None:
+            # the trees are neither materialized nor compared against a manifest or by checksums
+            logging.info("pipelined scan, compare and transfer")
+            return sync_pipelined(source, target, ignore_lastmodified, ignore_filesize, ignore_patterns, ignore_subdirs, progress, workdir,
+                                  simulate, num_workers, metrics, order, large_file_size, large_file_workers)
+        else:
+            return sync_one_way(source, target, ignore_lastmodified, ignore_filesize, ignore_patterns, ignore_hash, ignore_subdirs, progress,
+                                workdir, simulate, num_workers, depth_infinity, use_manifest, changed_paths, checksum, metrics,
+                                order, large_file_size, large_file_workers)
+    finally:
+        if target.type() == "webdav" and target.signatures is not None:
+            target.signatures.close()
+        for provider in [source, target]:
+            if provider.type() == "webdav" and provider.listing_cache is not None:
+                provider.listing_cache.close()
+        summary = metrics.finish()
+        logging.info("run summary " + json.dumps(summary))
+        try:
+            store_run_summary(workdir, summary)
+        except Exception as e:
+            logging.warning("error occurred storing run summary " + str(e))
+
+
+def sync_pipelined(source, target, ignore_lastmodified: bool, ignore_filesize: bool, ignore_patterns: List[str], ignore_subdirs: bool,
+                   progress: Progress, workdir: str, simulate: bool, num_workers: int, metrics: RunMetrics = None, order: TransferOrder = None,
+                   large_file_size: int = 0, large_file_workers: int = 1):
+    # scanning, comparing and copying overlap. The source hash is computed along the way, so it is not checked
+    # before the sync but stored after it (a following non pipelined sync of an unchanged source is skipped)
+    sync_prop_file = os.path.join(workdir, "sync.p")
+    hash_key = source.address + "->" + target.address
+    logging.info("pipelined sync of " + source.address + " and " + target.address + "... ")
+    scan = {}
+    transfer = Transfer(source, target, progress, simulate, num_workers, metrics, None, large_file_size, large_file_workers)
+    try:
+        transfer.run(pipelined_changes(source, target, ignore_patterns, ignore_lastmodified, ignore_filesize, ignore_subdirs, order, scan))
+    except Exception as e:
+        logging.error("Error occurred by scanning " + source.address + " and " + target.address + " " + str(e))
+        return transfer.num_files_copied
+    logging.info("source " + source.address + " - " + str(scan["files"]) + " files found (" + print_elapsed_time(scan["sec"]) + " scanning both sides)")
+    if metrics is not None:
+        metrics.observe_scan(source.address + " " + target.address, scan["sec"])
+    store_hash(sync_prop_file, hash_key, "0" if transfer.num_errors > 0 else str(scan["files"]) + "_" + str(scan["hash"]))
+
+    if transfer.num_errors > 0:
+        logging.info(">> " + str(transfer.num_errors) + " errors occurred. Sync has been terminated (imcomplete sync; " +  str(transfer.num_files_copied) + " file(s) copied)")
+    elif transfer.num_files_copied > 0:
+        logging.info(">> " + str(transfer.num_files_copied) + " file(s) copied")
+    else:
+        logging.info(">> no changes")
+    return transfer.num_files_copied
+
+
+def sync_one_way(source, target, ignore_lastmodified: bool, ignore_filesize: bool, ignore_patterns: List[str], ignore_hash: bool,
+                 ignore_subdirs: bool, progress: Progress, workdir: str, simulate: bool, num_workers: int, depth_infinity: bool,
+                 use_manifest: bool, changed_paths: List[str], checksum: bool, metrics: RunMetrics = None, order: TransferOrder = None,
+                 large_file_size: int = 0, large_file_workers: int = 1):
+    sync_prop_file = os.path.join(workdir, "sync.p")
 
     try:
         start = time.time()
-        source_file_tree = source.info_tree(ignore_subdirs)
+        if changed_paths is None:
+            logging.info("scanning source " + source.address + "... ")
+            source_file_tree = source.info_tree(ignore_subdirs, num_workers, depth_infinity)
+        else:
+            # incremental sync. Only the changed paths of the source are considered
+            logging.info("scanning " + str(len(changed_paths)) + " changed paths of source " + source.address + "... ")
+            source_file_tree = source.info_paths(changed_paths, ignore_subdirs)
         elapsed = time.time() - start
         logging.info("source " + source.address + " - " + str(len(source_file_tree.keys())) + " files found (" + print_elapsed_time(elapsed) + ")")
+        if metrics is not None:
+            metrics.observe_scan(source.address, elapsed)
     except Exception as e:
         logging.error("Error occurred by requesting " + source.address + " " + str(e))
         return 0
 
-    hashes = {}
     hash_key = source.address + "->" + target.address
     hash_code = compute_hash(source_file_tree)
     previous_hash_code = "<unset>"
-    if not ignore_hash:
+    if not ignore_hash and changed_paths is None:
         try:
-            if os.path.isfile(sync_prop_file):
-                with open(sync_prop_file, "rb") as f:
-                    hashes = pickle.load(f)
-                    if hash_key in hashes.keys():
-                        #logging.info(sync_prop_file + " entry found for key " + hash_key)
-                        previous_hash_code = hashes.get(hash_key)
-                        if hash_code == previous_hash_code:
-                            logging.info("source " + source.address + " - is unchanged")
-                            return 0
-                        else:
-                            logging.debug("hashcode " + hash_code + " != previous hashcode " + previous_hash_code + " (" + hash_key + ")")
-                    else:
-                        logging.debug(sync_prop_file + " no entry found for key " + hash_key)
-                        pass
+            hashes = load_hashes(sync_prop_file)
+            if hash_key in hashes.keys():
+                #logging.info(sync_prop_file + " entry found for key " + hash_key)
+                previous_hash_code = hashes.get(hash_key)
+                if hash_code == previous_hash_code:
+                    logging.info("source " + source.address + " - is unchanged")
+                    return 0
+                else:
+                    logging.debug("hashcode " + hash_code + " != previous hashcode " + previous_hash_code + " (" + hash_key + ")")
+            else:
+                logging.debug(sync_prop_file + " no entry found for key " + hash_key)
+                pass
         except Exception as e:
             logging.warning("error occurred scanning mail info tree" + str(e))
 
-    try:
-        logging.info("scanning target " + target.address + "... ")
-        start = time.time()
-        target_file_tree = target.info_tree(ignore_subdirs)
-        elapsed = time.time() - start
-        logging.info("target " + target.address + " - " + str(len(target_file_tree.keys())) + " files found (" + print_elapsed_time(elapsed) + ")")
-    except Exception as e:
-        logging.error("Error occurred by requesting " + target.address + " to fetch file info" + str(e))
-        return 0
+    manifest = Manifest(workdir, hash_key) if use_manifest else None
+    if manifest is not None and manifest.is_fresh(Manifest.TARGET):
+        # the target is known by previous syncs. No need to scan it
+        target_file_tree = {path: target.file_info(path, size, last_modified, etag) for path, (size, last_modified, etag) in manifest.entries(Manifest.TARGET).items()}
+        logging.info("target " + target.address + " - " + str(len(target_file_tree.keys())) + " files known by manifest")
+    else:
+        try:
+            start = time.time()
+            if changed_paths is None:
+                logging.info("scanning target " + target.address + "... ")
+                target_file_tree = target.info_tree(ignore_subdirs, num_workers, depth_infinity)
+            else:
+                # incremental sync. Only the dirs of the changed source files are looked up on the target
+                dirs = {path[:path.rindex("/")] for path in source_file_tree.keys()}
+                logging.info("scanning " + str(len(dirs)) + " dirs of target " + target.address + "... ")
+                target_file_tree = info_of_dirs(target, dirs)
+            elapsed = time.time() - start
+            logging.info("target " + target.address + " - " + str(len(target_file_tree.keys())) + " files found (" + print_elapsed_time(elapsed) + ")")
+            if metrics is not None:
+                metrics.observe_scan(target.address, elapsed)
+            # a partial listing does not replace the target entries of the manifest
+            if manifest is not None and changed_paths is None:
+                manifest.replace(Manifest.TARGET, manifest_entries(target_file_tree.values()))
+        except Exception as e:
+            logging.error("Error occurred by requesting " + target.address + " to fetch file info" + str(e))
+            if manifest is not None:
+                manifest.close()
+            return 0
+
+    # collecting new/updated artifacts
+    checksum_cache = ChecksumCache(workdir) if checksum else None
+    changed = changed_files(source_file_tree, target_file_tree, ignore_patterns, ignore_lastmodified, ignore_filesize, checksum_cache)
+    if checksum_cache is not None:
+        checksum_cache.close()
 
     # copying new/updated artifacts
-    num_files_copied  = 0
-    num_errors = 0
-    existing_dirs = set()
-    for file in sorted(source_file_tree.keys()):
-        if num_errors > 30:
-            logging.warning("to many errors. Stop syncing")
-            break
-        source_file = source_file_tree[file]
-        if file in target_file_tree.keys():
-            target_file = target_file_tree[file]
+    transfer = Transfer(source, target, progress, simulate, num_workers, metrics, order, large_file_size, large_file_workers)
+    transfer.run(changed)
+    num_files_copied = transfer.num_files_copied
+    num_errors = transfer.num_errors
+
+    if manifest is not None:
+        # copied files get the size and last modified time of their source. The target etag is unknown until the next scan
+        manifest.update(Manifest.TARGET, [(file.path, file.size, int(file.last_modified_epoch), None) for file in transfer.copied_files])
+        manifest.close()
+
+    # the hash covers the full source tree. An incremental sync leaves it untouched
+    if changed_paths is None:
+        if num_errors > 0:
+            logging.debug("Resetting hash")
+            new_hash_code = "0"  # reset hash entry
         else:
-            target_file = None
-
-        is_equals, reason = source_file.is_equals(target_file, ignore_lastmodified, ignore_filesize)
-        if not is_equals:
-            if is_ignored(ignore_patterns, source_file.path):
-                logging.debug("ignore file " + source_file.path)
-            else:
-                try:
-                    info = human_readable_size(source_file.size) +", " + source_file.last_modified.strftime("%Y-%m-%dT%H:%M:%S")
-                    if simulate:
-                        logging.info("simulate copying " + source.address +  "... to " + target.address + source_file.path +  " (" + info + ")  " + reason)
-                    else:
-                        logging.info("copying " + source.address +  "... to " + target.address + source_file.path +  " (" + info + ")  " + reason)
-                        start = time.time()
-                        source_file.copy_to(target)
-                        elapsed = time.time() - start
-                        logging.info("elapsed time " + print_elapsed_time(elapsed))
-                    num_files_copied = num_files_copied + 1
-                    if source.type() == 'local':
-                        progress.on_uploaded(source_file.filename)
-                    else:
-                        progress.on_downloaded(source_file.filename)
-                except ResponseErrorCode as re:
-                    logging.warning("FILECOPY ERROR copying " + source.address + source_file.path + " to " + target.address + source_file.path + " Got response error code " + str(re.code ), re)
-                    if re.code == 429:
-                        logging.info("waiting 30 sec to reduce request load ...")
-                        time.sleep(30)
-                except Exception as e:
-                    num_errors = num_errors + 1
-                    logging.warning("FILECOPY ERROR copying " + source.address + source_file.path + " to " + target.address + source_file.path, e)
-
-    if num_errors > 0:
-        logging.debug("Resetting hash")
-        hashes[hash_key] = "0"  # reset hash entry
-    else:
-        hashes[hash_key] = hash_code
-    if hashes[hash_key] != previous_hash_code:
-        logging.debug("update with new hash " + hash_code + " (" + hash_key + ")")
-        pass
-    with open(sync_prop_file, "wb") as f:
-        pickle.dump(hashes, f) # save hashes
+            new_hash_code = hash_code
+        if new_hash_code != previous_hash_code:
+            logging.debug("update with new hash " + hash_code + " (" + hash_key + ")")
+            pass
+        store_hash(sync_prop_file, hash_key, new_hash_code)
 
 
     if num_errors > 0:
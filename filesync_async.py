@@ -0,0 +1,365 @@
+import os
+import time
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import quote, unquote
+from typing import List, Dict, Optional
+from webdav3.exceptions import ResponseErrorCode
+from filesync import (FileInfo, FileStoreProvider, WebDavBase, WebDavStoreProvider, Progress, compute_hash, changed_files,
+                      human_readable_size, print_elapsed_time, load_hashes, store_hash)
+from ignore import IgnoreMatcher
+from metrics import RunMetrics, store_run_summary
+from ratelimit import host_limiter, retry_after_sec, backoff_sec
+
+
+
+class AsyncWebDavStoreProvider(WebDavBase):
+    """
+    asyncio variant of the webdav provider with the same info_tree/read/write contract (as coroutines). It shares
+    the listing parser and paths of the webdav providers, but none of the blocking request methods.
+    All requests share one aiohttp session with up to pool_size keep-alive connections. Up to max_concurrency
+    requests are in flight. Like the threaded providers, requests are limited by the host limiter of the host
+    (max_requests_per_sec, throttling). Resumable and delta uploads as well as cached listings are not supported
+    """
+
+    DEFAULT_MAX_CONCURRENCY = 64
+    LIMITER_POLL_SEC = 0.05
+
+    def __init__(self, address, chunk_size: int = WebDavBase.DEFAULT_CHUNK_SIZE, pool_size: int = DEFAULT_MAX_CONCURRENCY,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, direct_upload: bool = False, max_requests_per_sec: float = 0):
+        super().__init__(address, chunk_size)
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.direct_upload = direct_upload
+        self.limiter = host_limiter(self.host, max_concurrency, max_requests_per_sec)
+        # created by open(), within the event loop
+        self.session = None
+        self.semaphore = None
+
+    async def open(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size, ssl=False),
+                                             auth=aiohttp.BasicAuth(self.username, self.password))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def info_tree(self, ignore_subdirs: bool = False, depth_infinity: bool = False):
+        if ignore_subdirs:
+            info = await self.list_flat("/")
+        elif depth_infinity:
+            try:
+                info = await self.list_flat("/", depth="infinity")
+            except ResponseErrorCode as e:
+                logging.info("Depth: infinity PROPFIND not supported by " + self.address + " (" + str(e.code) + "). Crawling directories")
+                info = await self.list_deep("/")
+        else:
+            info = await self.list_deep("/")
+        return self.file_tree(info, depth_infinity)
+
+    async def list_deep(self, path):
+        # each directory is listed as soon as its parent is. The semaphore bounds the PROPFINDs in flight
+        info = []
+        async def crawl(dir_path):
+            entries = await self.list_flat(dir_path)
+            info.extend(entries)
+            await asyncio.gather(*[crawl(quote(fileinfo.path)) for fileinfo in entries if fileinfo.is_dir and not self.is_ignored_dir(fileinfo.path)])
+        await crawl(path)
+        return info
+
+    async def list_flat(self, path, depth: str = "1"):
+        status, headers, content = await self.request("PROPFIND", self.root + unquote(path),
+                                                      headers={"Depth": depth, "Content-Type": "application/xml"},
+                                                      data=self.PROPFIND_REQUEST.encode("utf-8"))
+        try:
+            return self.parse_propfind_response(path, content)
+        except Exception as e:
+            logging.error("Error occurred by parsing propfind response of " + self.address + path + " " + str(e))
+            raise e
+
+    async def read(self, filepath, local_target, last_modified_epoch):
+        temp_file = self.tempfile_name(local_target)
+        self.make_parents(temp_file)
+        remote_path = self.root + filepath
+        try:
+            async with self.semaphore:
+                await self.acquire()
+                start = time.time()
+                status, headers = None, {}
+                try:
+                    async with self.session.get(self.url(remote_path)) as r:
+                        status, headers = r.status, r.headers
+                        self.observe_request("GET", start, r.status)
+                        if r.status >= 400:
+                            raise ResponseErrorCode(self.url(remote_path), r.status, r.reason)
+                        with open(temp_file, "wb") as f:
+                            async for chunk in r.content.iter_chunked(self.chunk_size):
+                                f.write(chunk)
+                finally:
+                    self.release(status, headers)
+            os.replace(temp_file, local_target)
+            os.utime(local_target, (last_modified_epoch, last_modified_epoch))
+        except Exception as e:
+            logging.warning("error occurred downloading " + remote_path + " " + str(e))
+            self.delete_file(temp_file)
+            raise e
+
+    async def write(self, local_source, webdav_target, last_modified_epoch):
+        remote_path = self.root + webdav_target
+        time = self.http_date(last_modified_epoch)
+        upload_path = remote_path if self.direct_upload else self.tempfile_name(remote_path)
+        try:
+            await self.make_webdav_parents(upload_path)
+            with open(local_source, "rb") as f:
+                # the file is read in chunks by aiohttp. An empty file object would be sent chunked
+                await self.request("PUT", upload_path, data=f if os.path.getsize(local_source) > 0 else b"")
+            if not self.direct_upload:
+                await self.request("MOVE", upload_path, headers={"Destination": self.url(remote_path), "Overwrite": "T"})
+            await self.request("PROPPATCH", remote_path, headers={"Content-Type": "application/xml"}, data=self.PROPPATCH_REQUEST.format(time).encode("utf-8"))
+        except Exception as e:
+            logging.warning("error occurred uploading " + remote_path + " " + str(e))
+            if not self.direct_upload:
+                await self.request("DELETE", upload_path, accepted_codes=[404])
+            raise e
+
+    async def make_webdav_parents(self, filepath, max_depth=100):
+        parent = filepath[:filepath.rindex('/')]
+        if parent in self.known_dirs:
+            return
+        if max_depth > 0:
+            status, headers, content = await self.request("HEAD", parent, accepted_codes=[404])
+            if status == 404:
+                await self.make_webdav_parents(parent, max_depth - 1)
+                # 405: created by a concurrent upload in the meantime
+                await self.request("MKCOL", parent.rstrip("/") + "/", accepted_codes=[405])
+                logging.info("webdav dir " + parent + " created")
+            self.known_dirs.add(parent)
+        else:
+            logging.info("max depth of folder creation reached")
+
+    async def request(self, method: str, remote_path: str, headers: Dict[str, str] = None, accepted_codes: List[int] = list(), data=None):
+        # returns status, headers and body. Throttled requests are retried, as long as the body can be sent again
+        max_retries = self.MAX_RETRIES if data is None or isinstance(data, (bytes, str)) else 0
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                await self.acquire()
+                start = time.time()
+                status, response_headers = None, {}
+                try:
+                    async with self.session.request(method, self.url(remote_path), headers=headers, data=data) as r:
+                        content = await r.read()
+                        status, response_headers, reason = r.status, r.headers, r.reason
+                finally:
+                    self.release(status, response_headers)
+                self.observe_request(method, start, status)
+            if status >= 400 and status not in accepted_codes:
+                if status in self.THROTTLE_CODES and attempt < max_retries:
+                    # the host limiter pauses the requests to the host
+                    attempt = attempt + 1
+                    logging.debug(method + " " + remote_path + " throttled (" + str(status) + "). Retry " + str(attempt))
+                    continue
+                raise ResponseErrorCode(self.url(remote_path), status, reason)
+            return status, response_headers, content
+
+    async def acquire(self):
+        # the host limiter is shared with the threaded providers. It is polled, so the event loop is not blocked
+        while True:
+            wait_sec = self.limiter.try_acquire()
+            if wait_sec == 0:
+                return
+            await asyncio.sleep(self.LIMITER_POLL_SEC if wait_sec is None else wait_sec)
+
+    def release(self, status: Optional[int], headers):
+        # status is None, if the request failed without a response
+        throttled = status in self.THROTTLE_CODES
+        self.limiter.release(throttled, retry_after_sec(headers.get("Retry-After", None)) if throttled else None)
+
+    def observe_request(self, method: str, start: float, status: int):
+        if self.metrics is not None:
+            self.metrics.observe_request(self.host.split("://")[-1], method, time.time() - start, status)
+
+
+def async_storeprovider(address, chunk_size: int = WebDavStoreProvider.DEFAULT_CHUNK_SIZE, max_concurrency: int = AsyncWebDavStoreProvider.DEFAULT_MAX_CONCURRENCY, direct_upload: bool = False,
+                        max_requests_per_sec: float = 0):
+    if address.startswith("http"):
+        return AsyncWebDavStoreProvider(address, chunk_size, max_concurrency, max_concurrency, direct_upload, max_requests_per_sec)
+    else:
+        return FileStoreProvider(address)
+
+
+
+class AsyncTransfer:
+
+    MAX_ERRORS = 30
+    MAX_RETRIES = 5
+
+    def __init__(self, source, target, progress: Progress = None, simulate: bool = False, max_concurrency: int = 64, metrics: RunMetrics = None):
+        self.source = source
+        self.target = target
+        self.progress = Progress() if progress is None else progress
+        self.simulate = simulate
+        self.max_concurrency = max(1, max_concurrency)
+        self.metrics = metrics
+        self.num_files_copied = 0
+        self.num_errors = 0
+        self.copied_files = []
+
+    @property
+    def is_aborted(self) -> bool:
+        return self.num_errors > self.MAX_ERRORS
+
+    async def run(self, files):
+        queue = asyncio.Queue()
+        for source_file, reason in files:
+            queue.put_nowait((source_file, reason, 0))
+        workers = [asyncio.create_task(self.__work(queue)) for _ in range(min(self.max_concurrency, queue.qsize()))]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        if self.is_aborted:
+            logging.warning("to many errors. Stop syncing")
+
+    async def __work(self, queue: asyncio.Queue):
+        while True:
+            source_file, reason, attempt = await queue.get()
+            try:
+                if self.metrics is not None:
+                    self.metrics.set_queue_depth(queue.qsize())
+                if not self.is_aborted and not await self.copy(source_file, reason, attempt):
+                    # throttled. Requeued after a backoff
+                    await asyncio.sleep(backoff_sec(attempt + 1))
+                    queue.put_nowait((source_file, reason, attempt + 1))
+            finally:
+                queue.task_done()
+
+    async def copy(self, source_file: FileInfo, reason: str, attempt: int = 0) -> bool:
+        # returns False, if the copy has been throttled and should be retried
+        try:
+            info = human_readable_size(source_file.size) + ", " + source_file.last_modified.strftime("%Y-%m-%dT%H:%M:%S")
+            if self.simulate:
+                logging.info("simulate copying " + self.source.address + "... to " + self.target.address + source_file.path + " (" + info + ")  " + reason)
+            else:
+                logging.info("copying " + self.source.address + "... to " + self.target.address + source_file.path + " (" + info + ")  " + reason)
+                start = time.time()
+                if self.source.type() == "local" and self.target.type() == "webdav":
+                    await self.target.write(source_file.root + source_file.path, source_file.path, source_file.last_modified_epoch)
+                elif self.source.type() == "webdav" and self.target.type() == "local":
+                    await self.source.read(source_file.path, self.target.address + source_file.path, source_file.last_modified_epoch)
+                else:
+                    raise Exception("async copy supports local <-> webdav only")
+                logging.info("elapsed time " + print_elapsed_time(time.time() - start) + " (" + source_file.path + ")")
+                self.copied_files.append(source_file)
+                if self.metrics is not None:
+                    self.metrics.add_transfer(source_file.size)
+            self.num_files_copied = self.num_files_copied + 1
+            # progress listeners may block (e.g. the remote display). They must not stall the event loop
+            if self.source.type() == 'local':
+                await asyncio.to_thread(self.progress.on_uploaded, source_file.filename)
+            else:
+                await asyncio.to_thread(self.progress.on_downloaded, source_file.filename)
+        except ResponseErrorCode as re:
+            logging.warning("FILECOPY ERROR copying " + self.source.address + source_file.path + " to " + self.target.address + source_file.path + " Got response error code " + str(re.code))
+            if re.code in WebDavStoreProvider.THROTTLE_CODES and attempt < self.MAX_RETRIES:
+                logging.info("requeuing " + source_file.path + " (retry " + str(attempt + 1) + ")")
+                return False
+            self.__add_error()
+        except Exception as e:
+            self.__add_error()
+            logging.warning("FILECOPY ERROR copying " + self.source.address + source_file.path + " to " + self.target.address + source_file.path + " " + str(e))
+        return True
+
+    def __add_error(self):
+        self.num_errors = self.num_errors + 1
+        if self.metrics is not None:
+            self.metrics.add_error()
+
+
+async def scan(provider, ignore_subdirs: bool, depth_infinity: bool):
+    if provider.type() == "local":
+        # the local scan is blocking
+        return await asyncio.to_thread(provider.info_tree, ignore_subdirs)
+    else:
+        return await provider.info_tree(ignore_subdirs, depth_infinity)
+
+
+async def sync_folder_async(source_address: str,
+                            target_address: str,
+                            ignore_lastmodified: bool = False,
+                            ignore_filesize: bool = False,
+                            ignore_patterns: List[str] = list(),
+                            ignore_hash: bool = False,
+                            ignore_subdirs: bool = False,
+                            progress: Progress = None,
+                            workdir: str = "/etc/sync",
+                            simulate: bool = False,
+                            max_concurrency: int = AsyncWebDavStoreProvider.DEFAULT_MAX_CONCURRENCY,
+                            depth_infinity: bool = False,
+                            chunk_size: int = WebDavStoreProvider.DEFAULT_CHUNK_SIZE,
+                            direct_upload: bool = False,
+                            max_requests_per_sec: float = 0):
+    # one-way sync like sync_folder, driven by the running event loop
+    source = async_storeprovider(source_address, chunk_size, max_concurrency, direct_upload, max_requests_per_sec)
+    target = async_storeprovider(target_address, chunk_size, max_concurrency, direct_upload, max_requests_per_sec)
+    sync_prop_file = os.path.join(workdir, "sync.p")
+    ignore_patterns = ignore_patterns + ['*/' + WebDavStoreProvider.TEMP_PREFIX + '*']
+    logging.info("async sync artifacts from '" + source.address + "' to '" + target.address + "' using ignore patterns " + ", ".join(ignore_patterns) + " (" + str(max_concurrency) + " concurrent requests)")
+
+    metrics = RunMetrics(source.address + "->" + target.address)
+    source.ignore = IgnoreMatcher(ignore_patterns)
+    target.ignore = source.ignore
+    webdav_providers = [provider for provider in [source, target] if provider.type() == "webdav"]
+    for provider in webdav_providers:
+        provider.metrics = metrics
+        await provider.open()
+    try:
+        try:
+            start = time.time()
+            source_file_tree = await scan(source, ignore_subdirs, depth_infinity)
+            elapsed = time.time() - start
+            metrics.observe_scan(source.address, elapsed)
+            logging.info("source " + source.address + " - " + str(len(source_file_tree.keys())) + " files found (" + print_elapsed_time(elapsed) + ")")
+        except Exception as e:
+            logging.error("Error occurred by requesting " + source.address + " " + str(e))
+            return 0
+
+        hash_key = source.address + "->" + target.address
+        hash_code = compute_hash(source_file_tree)
+        if not ignore_hash:
+            try:
+                if load_hashes(sync_prop_file).get(hash_key, None) == hash_code:
+                    logging.info("source " + source.address + " - is unchanged")
+                    return 0
+            except Exception as e:
+                logging.warning("error occurred reading " + sync_prop_file + " " + str(e))
+
+        try:
+            start = time.time()
+            target_file_tree = await scan(target, ignore_subdirs, depth_infinity)
+            elapsed = time.time() - start
+            metrics.observe_scan(target.address, elapsed)
+            logging.info("target " + target.address + " - " + str(len(target_file_tree.keys())) + " files found (" + print_elapsed_time(elapsed) + ")")
+        except Exception as e:
+            logging.error("Error occurred by requesting " + target.address + " to fetch file info" + str(e))
+            return 0
+
+        transfer = AsyncTransfer(source, target, progress, simulate, max_concurrency, metrics)
+        await transfer.run(changed_files(source_file_tree, target_file_tree, ignore_patterns, ignore_lastmodified, ignore_filesize))
+        store_hash(sync_prop_file, hash_key, "0" if transfer.num_errors > 0 else hash_code)
+
+        if transfer.num_errors > 0:
+            logging.info(">> " + str(transfer.num_errors) + " errors occurred. Sync has been terminated (imcomplete sync; " + str(transfer.num_files_copied) + " file(s) copied)")
+        elif transfer.num_files_copied > 0:
+            logging.info(">> " + str(transfer.num_files_copied) + " file(s) copied")
+        else:
+            logging.info(">> no changes")
+        return transfer.num_files_copied
+    finally:
+        for provider in webdav_providers:
+            await provider.close()
+        try:
+            store_run_summary(workdir, metrics.finish())
+        except Exception as e:
+            logging.warning("error occurred storing run summary " + str(e))
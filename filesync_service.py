@@ -1,26 +1,103 @@
 import sys
+import asyncio
 import logging
 import traceback
 import os
+import threading
+import signal
 import yaml
 import pycron
 from datetime import datetime
-from time import sleep
-from typing import Dict, Any, List
+from time import sleep, time
+from typing import Dict, Any, List, Callable, Optional, Awaitable
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, Future
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from filesync import sync_folder, Progress
-from display import Display, RemoteDisplay
+from metrics import start_metrics_server
+from shaping import bandwidth_limiter, parse_size
+from filesync import sync_folder, Progress, WebDavStoreProvider
+from filesync_async import sync_folder_async, AsyncWebDavStoreProvider
+from display import Display, remote_display, flush_remote_displays
 
 
 
 class FileHandler(FileSystemEventHandler):
+    """
+    reloads the configs on a change of the config dir. The config dir is the workdir as well, so changes of
+    the workdir artifacts (including their temp and journal files) are ignored
+    """
+
+    WORKDIR_ARTIFACTS = ("sync.p", "manifest.db", "checksums.db", "runs.json")
 
     def __init__(self, change_listener):
         self.__change_listener = change_listener
 
+    def on_created(self, event) -> None:
+        self.__on_change(event.src_path)
+
+    def on_deleted(self, event) -> None:
+        self.__on_change(event.src_path)
+
     def on_modified(self, event) -> None:
-        self.__change_listener()
+        # a modified dir is reported for each file written to it (e.g. by the workdir artifacts)
+        if not event.is_directory:
+            self.__on_change(event.src_path)
+
+    def on_moved(self, event) -> None:
+        # e.g. an editor saving by renaming a temp file to the config
+        self.__on_change(event.src_path, event.dest_path)
+
+    def __on_change(self, *paths):
+        if any(not os.path.basename(str(path)).startswith(self.WORKDIR_ARTIFACTS) for path in paths):
+            self.__change_listener()
+
+
+
+class ChangeJournal(FileSystemEventHandler):
+    """
+    records the paths (relative to the watched source) of created, modified and moved files.
+    The paths are released by drain() not before the source has been quiet for DEBOUNCE_SEC, or
+    at the latest MAX_WAIT_SEC after the first recorded change (a source which is written continuously)
+    """
+
+    DEBOUNCE_SEC = 3
+    MAX_WAIT_SEC = 60
+
+    def __init__(self, source: str):
+        self.source = source.rstrip("/")
+        self.__lock = threading.Lock()
+        self.__paths = set()
+        self.__last_event = 0
+        self.__first_event = 0
+
+    def on_created(self, event) -> None:
+        self.__record(event.src_path)
+
+    def on_modified(self, event) -> None:
+        if not event.is_directory:
+            self.__record(event.src_path)
+
+    def on_moved(self, event) -> None:
+        self.__record(event.dest_path)
+
+    def __record(self, path):
+        path = str(path).replace("\\", "/")
+        if path.startswith(self.source + "/"):
+            with self.__lock:
+                if len(self.__paths) == 0:
+                    self.__first_event = time()
+                self.__paths.add(path[len(self.source):])
+                self.__last_event = time()
+
+    def drain(self) -> List[str]:
+        with self.__lock:
+            now = time()
+            if len(self.__paths) == 0 or (now - self.__last_event < self.DEBOUNCE_SEC and now - self.__first_event < self.MAX_WAIT_SEC):
+                return []
+            paths = sorted(self.__paths)
+            self.__paths.clear()
+            return paths
 
 
 
@@ -28,8 +105,11 @@ class FileHandler(FileSystemEventHandler):
 
 class Task:
 
-    def __init__(self, conf: Dict[str, Any]):
+    def __init__(self, conf: Dict[str, Any], shared_max_bandwidth: Any = 0):
         self.__conf = conf
+        # the max_bandwidth of the config
+        self.shared_max_bandwidth = shared_max_bandwidth
+        self.__async_io_logged = False
 
     @property
     def source(self) -> str:
@@ -59,6 +139,139 @@ class Task:
     def ignore_hash(self) -> bool:
         return self.__conf.get('ignore_hash', False)
 
+    @property
+    def num_workers(self) -> int:
+        return int(self.__conf.get('num_workers', 1))
+
+    @property
+    def depth_infinity(self) -> bool:
+        return self.__conf.get('depth_infinity', False)
+
+    @property
+    def use_manifest(self) -> bool:
+        return self.__conf.get('use_manifest', False)
+
+    @property
+    def chunk_size(self) -> int:
+        return int(self.__conf.get('chunk_size', WebDavStoreProvider.DEFAULT_CHUNK_SIZE))
+
+    @property
+    def resumable_uploads(self) -> bool:
+        return self.__conf.get('resumable_uploads', False)
+
+    @property
+    def pool_size(self) -> int:
+        return self.__conf.get('pool_size', None)
+
+    @property
+    def direct_upload(self) -> bool:
+        return self.__conf.get('direct_upload', False)
+
+    @property
+    def checksum(self) -> bool:
+        return self.__conf.get('checksum', False)
+
+    @property
+    def etag_md5(self) -> bool:
+        # the webdav server provides the md5 of the content as etag (like S3 based servers)
+        return self.__conf.get('etag_md5', False)
+
+    @property
+    def max_requests_per_sec(self) -> float:
+        return float(self.__conf.get('max_requests_per_sec', 0))
+
+    @property
+    def bidirectional(self) -> bool:
+        return self.__conf.get('bidirectional', False)
+
+    @property
+    def delta_uploads(self) -> bool:
+        return self.__conf.get('delta_uploads', False)
+
+    @property
+    def cached_listing(self) -> bool:
+        return self.__conf.get('cached_listing', False)
+
+    @property
+    def transfer_order(self) -> str:
+        # path, smallest_first or newest_first
+        return self.__conf.get('transfer_order', 'path')
+
+    @property
+    def priority_patterns(self) -> List[str]:
+        return self.__conf.get('priority_patterns', [])
+
+    @property
+    def max_bandwidth(self) -> Any:
+        # bytes per sec like "2M", or a time of day profile like {"08:00-18:00": "1M", "default": 0}
+        return self.__conf.get('max_bandwidth', 0)
+
+    @property
+    def large_file_size(self) -> int:
+        return int(parse_size(self.__conf.get('large_file_size', 0)))
+
+    @property
+    def large_file_workers(self) -> int:
+        return int(self.__conf.get('large_file_workers', 1))
+
+    @property
+    def pipelined(self) -> bool:
+        return self.__conf.get('pipelined', False)
+
+    @property
+    def pack_size(self) -> int:
+        # files smaller than pack_size are uploaded packed into segments (0 = no packing)
+        return int(parse_size(self.__conf.get('pack_size', 0)))
+
+    @property
+    def compress(self) -> bool:
+        return self.__conf.get('compress', False)
+
+    @property
+    def async_io(self) -> bool:
+        # one-way syncs between a local dir and a webdav server without the options the async variant does not support
+        if not self.__conf.get('async_io', False):
+            return False
+        unsupported = self.async_io_unsupported
+        if len(unsupported) > 0:
+            if not self.__async_io_logged:
+                self.__async_io_logged = True
+                logging.warning(str(self) + " async_io is not supported with " + ", ".join(unsupported) + ". Running it in a worker thread")
+            return False
+        return True
+
+    @property
+    def async_io_unsupported(self) -> List[str]:
+        options = {"bidirectional": self.bidirectional,
+                   "pack_size": self.pack_size > 0,
+                   "compress": self.compress,
+                   "checksum": self.checksum,
+                   "use_manifest": self.use_manifest,
+                   "resumable_uploads": self.resumable_uploads,
+                   "delta_uploads": self.delta_uploads,
+                   "cached_listing": self.cached_listing,
+                   "pipelined": self.pipelined,
+                   "max_bandwidth": bool(self.max_bandwidth) or bool(self.shared_max_bandwidth),
+                   "transfer_order": self.transfer_order != "path",
+                   "priority_patterns": len(self.priority_patterns) > 0,
+                   "large_file_size": self.large_file_size > 0,
+                   "source and target of the same type": self.source.startswith("http") == self.target.startswith("http")}
+        return [name for name, is_set in options.items() if is_set]
+
+    @property
+    def max_concurrency(self) -> int:
+        return int(self.__conf.get('max_concurrency', AsyncWebDavStoreProvider.DEFAULT_MAX_CONCURRENCY))
+
+    @property
+    def watch(self) -> bool:
+        # local sources only
+        return self.__conf.get('watch', False) and not self.source.startswith("http")
+
+    @property
+    def hosts(self) -> List[str]:
+        # the webdav hosts used by the task
+        return sorted({urlparse(address).hostname for address in [self.source, self.target] if address.startswith("http")})
+
     def __hash__(self):
         return hash(self.__str__())
 
@@ -75,12 +288,118 @@ class Config:
         self.cron = conf['cron'].strip()
         self.display = conf.get('display', "").strip()
         self.simulate = conf.get('simulate', False)
-        self.tasks = [Task(task) for task in conf['tasks']]
+        # shared by all tasks of the config
+        self.max_bandwidth = conf.get('max_bandwidth', 0)
+        self.tasks = [Task(task, self.max_bandwidth) for task in conf['tasks']]
 
     def __hash__(self):
         return hash(self.cron + ",".join([str(task) for task in self.tasks]))
 
 
+class TaskScheduler:
+    """
+    runs tasks concurrently, limited by max_tasks in total and by max_tasks_per_host per webdav host.
+    A task whose hosts are busy is deferred without occupying a worker, so tasks of other hosts are not
+    queued behind it. Async tasks run on a single event loop thread and are limited by max_tasks_per_host only.
+    A task that is still running (or deferred) is not started twice
+    """
+
+    def __init__(self, max_tasks: int = 4, max_tasks_per_host: int = 2):
+        self.max_tasks = max_tasks
+        self.max_tasks_per_host = max_tasks_per_host
+        self.__executor = ThreadPoolExecutor(max_workers=max_tasks, thread_name_prefix="task")
+        self.__lock = threading.Lock()
+        self.__running = set()
+        self.__host_tasks = dict()   # host -> number of started tasks
+        self.__deferred = []   # (task, start, future) of tasks waiting for a busy host, in submit order
+        self.__loop = None
+
+    def is_running(self, task: Task) -> bool:
+        with self.__lock:
+            return str(task) in self.__running
+
+    def submit(self, task: Task, run: Callable[[], None]) -> Optional[Future]:
+        return self.__submit(task, lambda future: self.__executor.submit(self.__run, task, run, future))
+
+    def submit_async(self, task: Task, run: Callable[[], Awaitable[None]]) -> Optional[Future]:
+        return self.__submit(task, lambda future: asyncio.run_coroutine_threadsafe(self.__run_async(task, run, future), self.__event_loop()))
+
+    def __submit(self, task: Task, start: Callable[[Future], Any]) -> Optional[Future]:
+        # the returned future is done, when the task has been run
+        future = Future()
+        with self.__lock:
+            if str(task) in self.__running:
+                logging.info(str(task) + " is still running. Skipping it")
+                return None
+            self.__running.add(str(task))
+            if not self.__has_capacity(task):
+                logging.info(str(task) + " waits for host " + ", ".join(task.hosts))
+                self.__deferred.append((task, start, future))
+                return future
+            self.__reserve(task)
+        start(future)
+        return future
+
+    def __run(self, task: Task, run: Callable[[], None], future: Future):
+        try:
+            run()
+        except Exception as e:
+            logging.warning("Error occurred processing " + str(task) + "  " + str(e))
+            logging.warning(traceback.format_exc())
+        finally:
+            self.__finish(task)
+            future.set_result(None)
+
+    async def __run_async(self, task: Task, run: Callable[[], Awaitable[None]], future: Future):
+        try:
+            await run()
+        except Exception as e:
+            logging.warning("Error occurred processing " + str(task) + "  " + str(e))
+            logging.warning(traceback.format_exc())
+        finally:
+            self.__finish(task)
+            future.set_result(None)
+
+    def __has_capacity(self, task: Task) -> bool:
+        return all(self.__host_tasks.get(host, 0) < self.max_tasks_per_host for host in task.hosts)
+
+    def __reserve(self, task: Task):
+        for host in task.hosts:
+            self.__host_tasks[host] = self.__host_tasks.get(host, 0) + 1
+
+    def __finish(self, task: Task):
+        # releases the hosts of the task and starts the deferred tasks, which fit now
+        ready = []
+        with self.__lock:
+            self.__running.discard(str(task))
+            for host in task.hosts:
+                self.__host_tasks[host] -= 1
+            for entry in list(self.__deferred):
+                if self.__has_capacity(entry[0]):
+                    self.__reserve(entry[0])
+                    self.__deferred.remove(entry)
+                    ready.append(entry)
+        for deferred_task, start, future in ready:
+            start(future)
+
+    def __event_loop(self) -> asyncio.AbstractEventLoop:
+        with self.__lock:
+            if self.__loop is None:
+                self.__loop = asyncio.new_event_loop()
+                threading.Thread(target=self.__loop.run_forever, name="task-loop", daemon=True).start()
+            return self.__loop
+
+    def shutdown(self):
+        with self.__lock:
+            deferred, self.__deferred = self.__deferred, []
+        for task, start, future in deferred:
+            future.cancel()
+        self.__executor.shutdown(wait=False)
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+
+
 class Sync(Progress):
 
     def __init__(self, config: Config, workdir: str):
@@ -88,46 +407,145 @@ class Sync(Progress):
         self.num_down = 0
         self.config = config
         self.workdir = workdir
-        self.display = Display() if len(config.display) == 0 else RemoteDisplay(config.display)
+        self.display = Display() if len(config.display) == 0 else remote_display(config.display)
+        self.bandwidth = bandwidth_limiter(config.file, config.max_bandwidth) if config.max_bandwidth else None
+        self.__lock = threading.Lock()
+        self.__num_pending = 0
 
-    def execute(self):
+    def execute(self, scheduler: TaskScheduler = None):
         logging.info("executing sync " + self.config.file + " cron='" + self.config.cron + "' display=" + self.config.display)
-        for task in self.config.tasks:
-            self.display.show("sync\n\r" + task.target.split("/")[-1] + "...")
-            sync_folder(source_address=task.source,
-                        target_address=task.target,
-                        ignore_lastmodified=task.ignore_lastmodified,
-                        ignore_filesize=task.ignore_filesize,
-                        ignore_patterns=task.ignore_patterns,
-                        ignore_hash=task.ignore_hash,
-                        ignore_subdirs=task.ignore_subdirs,
-                        progress=self,
-                        workdir=self.workdir,
-                        simulate=self.config.simulate)
+        if scheduler is None:
+            for task in self.config.tasks:
+                self.__run(task)
+            self.__show_summary()
+            self.display.flush()
+        else:
+            futures = [scheduler.submit_async(task, lambda task=task: self.__run_async(task)) if task.async_io else scheduler.submit(task, lambda task=task: self.__run(task))
+                       for task in self.config.tasks]
+            futures = [future for future in futures if future is not None]
+            self.__num_pending = len(futures)
+            for future in futures:
+                future.add_done_callback(self.__on_task_done)
+
+    def execute_changes(self, task: Task, changed_paths: List[str], scheduler: TaskScheduler = None):
+        logging.info("executing incremental sync " + self.config.file + " (" + str(task) + ", " + str(len(changed_paths)) + " changed paths)")
+        if scheduler is None:
+            self.__sync(task, changed_paths)
+            self.__show_summary()
+            self.display.flush()
+        else:
+            future = scheduler.submit(task, lambda: self.__sync(task, changed_paths))
+            if future is not None:
+                self.__num_pending = 1
+                future.add_done_callback(self.__on_task_done)
+
+    def __run(self, task: Task):
+        self.display.show("sync\n\r" + task.target.split("/")[-1] + "...")
+        self.__sync(task)
+
+    async def __run_async(self, task: Task):
+        self.display.show("sync\n\r" + task.target.split("/")[-1] + "...")
+        await self.__sync_async(task)
+
+    def __on_task_done(self, future: Future):
+        with self.__lock:
+            self.__num_pending -= 1
+            is_last = self.__num_pending == 0
+        if is_last:
+            self.__show_summary()
+
+    def __show_summary(self):
         self.display.show(datetime.now().strftime("%d %b, %H:%M") + "\n\r" + str(self.num_down) + " down; " +  str(self.num_up) + " up")
 
+    def __sync(self, task: Task, changed_paths: List[str] = None):
+        if task.async_io and changed_paths is None:
+            # a sync without scheduler
+            asyncio.run(self.__sync_async(task))
+            return
+        sync_folder(source_address=task.source,
+                    target_address=task.target,
+                    ignore_lastmodified=task.ignore_lastmodified,
+                    ignore_filesize=task.ignore_filesize,
+                    ignore_patterns=task.ignore_patterns,
+                    ignore_hash=task.ignore_hash,
+                    ignore_subdirs=task.ignore_subdirs,
+                    progress=self,
+                    workdir=self.workdir,
+                    simulate=self.config.simulate,
+                    num_workers=task.num_workers,
+                    depth_infinity=task.depth_infinity,
+                    use_manifest=task.use_manifest,
+                    changed_paths=changed_paths,
+                    chunk_size=task.chunk_size,
+                    resumable_uploads=task.resumable_uploads,
+                    pool_size=task.pool_size,
+                    direct_upload=task.direct_upload,
+                    checksum=task.checksum,
+                    max_requests_per_sec=task.max_requests_per_sec,
+                    bidirectional=task.bidirectional,
+                    delta_uploads=task.delta_uploads,
+                    cached_listing=task.cached_listing,
+                    transfer_order=task.transfer_order,
+                    priority_patterns=task.priority_patterns,
+                    max_bandwidth=task.max_bandwidth,
+                    shared_bandwidth=self.bandwidth,
+                    large_file_size=task.large_file_size,
+                    large_file_workers=task.large_file_workers,
+                    pipelined=task.pipelined,
+                    pack_size=task.pack_size,
+                    compress=task.compress,
+                    etag_md5=task.etag_md5)
+
+    async def __sync_async(self, task: Task):
+        await sync_folder_async(source_address=task.source,
+                                target_address=task.target,
+                                ignore_lastmodified=task.ignore_lastmodified,
+                                ignore_filesize=task.ignore_filesize,
+                                ignore_patterns=task.ignore_patterns,
+                                ignore_hash=task.ignore_hash,
+                                ignore_subdirs=task.ignore_subdirs,
+                                progress=self,
+                                workdir=self.workdir,
+                                simulate=self.config.simulate,
+                                max_concurrency=task.max_concurrency,
+                                depth_infinity=task.depth_infinity,
+                                chunk_size=task.chunk_size,
+                                direct_upload=task.direct_upload,
+                                max_requests_per_sec=task.max_requests_per_sec)
+
     def on_uploaded(self, filename: str):
-        self.num_up += 1
+        # tasks of a sync may run concurrently
+        with self.__lock:
+            self.num_up += 1
         self.display.show("sync...\n\r" + filename)
 
     def on_downloaded(self, filename: str):
-        self.num_down += 1
+        with self.__lock:
+            self.num_down += 1
         self.display.show("sync...\n\r" + filename)
 
 
 
 class FilesyncService:
 
-    def __init__(self, dir: str):
+    def __init__(self, dir: str, max_tasks: int = 4, max_tasks_per_host: int = 2, metrics_port: int = 0):
         self.__is_running = True
         self.dir = dir
+        self.metrics_port = metrics_port   # 0 = no metrics endpoint
+        self.metrics_server = None
+        self.scheduler = TaskScheduler(max_tasks, max_tasks_per_host)
         self.observer = Observer()
         self.configs = list()
+        self.journals = dict()
+        self.__watches = dict()
+        self.__last_cron_minute = None
 
     def start(self):
         self.__is_running = True
         self.observer.schedule(FileHandler(self.__reload), self.dir, recursive=False)
         self.observer.start()
+        if self.metrics_port > 0:
+            self.metrics_server = start_metrics_server(self.metrics_port, self.dir)
         self.__reload()
         self.__cron_loop()
 
@@ -135,6 +553,11 @@ class FilesyncService:
     def close(self):
         self.__is_running = False
         self.observer.stop()
+        self.scheduler.shutdown()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        # the last summaries of the syncs
+        flush_remote_displays()
 
     def __reload(self):
         new_configs = set()
@@ -150,20 +573,65 @@ class FilesyncService:
             except Exception as e:
                 logging.warning("error occurred by loading " + str(fn) + " "  + str(e))
         self.configs = new_configs
+        self.__rewatch()
+
+    def __rewatch(self):
+        # one journal per watched task. Journals of unchanged tasks survive a reload with their pending changes
+        tasks = {str(task): task for config in self.configs for task in config.tasks if task.watch}
+        for key in list(self.__watches.keys()):
+            if key not in tasks.keys():
+                self.observer.unschedule(self.__watches.pop(key))
+                self.journals.pop(key)
+                logging.info("stop watching " + key)
+        for key, task in tasks.items():
+            if key not in self.__watches.keys():
+                try:
+                    journal = ChangeJournal(task.source)
+                    self.__watches[key] = self.observer.schedule(journal, task.source, recursive=True)
+                    self.journals[key] = journal
+                    logging.info("watching " + task.source)
+                except Exception as e:
+                    logging.warning("error occurred by watching " + task.source + " " + str(e))
 
     def __cron_loop(self):
         while self.__is_running:
-            for config in self.configs:
-                try:
-                    if pycron.is_now(config.cron):
-                        Sync(config, self.dir).execute()
-                except Exception as e:
-                    logging.warning("Error occurred processing sync for " + config.file + "  " + str(e))
-                    logging.warning(traceback.format_exc())
-            sleep(40)  # <60 and >30
+            minute = datetime.now().strftime("%Y-%m-%dT%H:%M")
+            if minute != self.__last_cron_minute:
+                self.__last_cron_minute = minute
+                for config in self.configs:
+                    try:
+                        if pycron.is_now(config.cron):
+                            Sync(config, self.dir).execute(self.scheduler)
+                    except Exception as e:
+                        logging.warning("Error occurred processing sync for " + config.file + "  " + str(e))
+                        logging.warning(traceback.format_exc())
+            self.__sync_changes()
+            sleep(1)
+
+    def __sync_changes(self):
+        for config in self.configs:
+            for task in config.tasks:
+                journal = self.journals.get(str(task), None)
+                # changes are kept in the journal, as long as the task is running
+                if journal is not None and not self.scheduler.is_running(task):
+                    changed_paths = journal.drain()
+                    if len(changed_paths) > 0:
+                        try:
+                            Sync(config, self.dir).execute_changes(task, changed_paths, self.scheduler)
+                        except Exception as e:
+                            logging.warning("Error occurred processing incremental sync for " + config.file + "  " + str(e))
+                            logging.warning(traceback.format_exc())
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
-    srv = FilesyncService(sys.argv[1])
-    srv.start()
+    max_tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    max_tasks_per_host = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    metrics_port = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    srv = FilesyncService(sys.argv[1], max_tasks, max_tasks_per_host, metrics_port)
+    # a stop of the container is handled like Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        srv.start()
+    finally:
+        srv.close()
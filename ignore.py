@@ -0,0 +1,52 @@
+import re
+import fnmatch
+from typing import List
+
+
+GLOB_CHARS = "*?["
+
+
+
+class IgnoreMatcher:
+    """
+    ignore patterns (fnmatch syntax, matched against the path relative to the sync root) compiled once.
+    Literal patterns are looked up in a set, "*suffix" and "prefix*" patterns are matched by endswith/startswith,
+    the remaining ones by a single regex
+    """
+
+    def __init__(self, ignore_patterns: List[str]):
+        self.ignore_patterns = list(ignore_patterns)
+        self.literals = set()
+        suffixes = []
+        prefixes = []
+        globs = []
+        for pattern in self.ignore_patterns:
+            if not any(c in pattern for c in GLOB_CHARS):
+                self.literals.add(pattern)
+            elif pattern.startswith("*") and not any(c in pattern[1:] for c in GLOB_CHARS):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith("*") and not any(c in pattern[:-1] for c in GLOB_CHARS):
+                prefixes.append(pattern[:-1])
+            else:
+                globs.append(pattern)
+        self.suffixes = tuple(suffixes)
+        self.prefixes = tuple(prefixes)
+        self.regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in globs)) if len(globs) > 0 else None
+        # a pattern ending with * matches all paths below a dir, if it matches the dir path followed by a slash
+        dir_globs = [pattern for pattern in globs if pattern.endswith("*")]
+        self.dir_regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in dir_globs)) if len(dir_globs) > 0 else None
+
+    def __len__(self):
+        return len(self.ignore_patterns)
+
+    def is_ignored(self, path: str) -> bool:
+        return (path in self.literals
+                or (len(self.suffixes) > 0 and path.endswith(self.suffixes))
+                or (len(self.prefixes) > 0 and path.startswith(self.prefixes))
+                or (self.regex is not None and self.regex.match(path) is not None))
+
+    def is_ignored_dir(self, dir_path: str) -> bool:
+        # True, if all paths below the dir are ignored. Such a dir does not need to be scanned at all
+        dir_path = dir_path.rstrip("/") + "/"
+        return ((len(self.prefixes) > 0 and dir_path.startswith(self.prefixes))
+                or (self.dir_regex is not None and self.dir_regex.match(dir_path) is not None))
@@ -0,0 +1,85 @@
+import os
+import time
+import sqlite3
+from typing import Dict, Iterable, Tuple, Optional
+
+
+class Manifest:
+    """
+    per-file state of a source->target pair, stored in <workdir>/manifest.db
+
+    The target side is the state of the target as known by the last sync. As long as it is fresh,
+    sync_folder uses it instead of scanning the target. A bidirectional sync stores both sides, as the
+    baseline of its next run
+    """
+
+    SOURCE = "source"
+    TARGET = "target"
+
+    MAX_AGE_SEC = 24 * 60 * 60   # full target rescan at least once a day
+
+    def __init__(self, workdir: str, pair: str):
+        self.pair = pair
+        self.__conn = sqlite3.connect(os.path.join(workdir, "manifest.db"), timeout=60)
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS files (pair TEXT, side TEXT, path TEXT, size INTEGER, last_modified INTEGER, etag TEXT, PRIMARY KEY (pair, side, path))")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS scans (pair TEXT, side TEXT, scanned INTEGER, PRIMARY KEY (pair, side))")
+
+    def close(self):
+        self.__conn.close()
+
+    def last_scanned(self, side: str) -> float:
+        row = self.__conn.execute("SELECT scanned FROM scans WHERE pair = ? AND side = ?", (self.pair, side)).fetchone()
+        return 0 if row is None else row[0]
+
+    def is_fresh(self, side: str) -> bool:
+        return time.time() - self.last_scanned(side) < self.MAX_AGE_SEC
+
+    def entries(self, side: str) -> Dict[str, Tuple[int, int, Optional[str]]]:
+        rows = self.__conn.execute("SELECT path, size, last_modified, etag FROM files WHERE pair = ? AND side = ?", (self.pair, side))
+        return {path: (size, last_modified, etag) for path, size, last_modified, etag in rows}
+
+    def replace(self, side: str, entries: Iterable[Tuple[str, int, int, Optional[str]]]):
+        # replaces all entries of the side by the result of a full scan
+        with self.__conn:
+            self.__conn.execute("DELETE FROM files WHERE pair = ? AND side = ?", (self.pair, side))
+            self.__conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                    ((self.pair, side, path, size, last_modified, etag) for path, size, last_modified, etag in entries))
+            self.__conn.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?)", (self.pair, side, int(time.time())))
+
+    def update(self, side: str, entries: Iterable[Tuple[str, int, int, Optional[str]]]):
+        with self.__conn:
+            self.__conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                    ((self.pair, side, path, size, last_modified, etag) for path, size, last_modified, etag in entries))
+
+
+class ListingCache:
+    """
+    the listing of a webdav tree as known by the last scan, stored in <workdir>/manifest.db. Together with
+    the change token (ctag/etag) of the root collection and the sync-token (RFC 6578), if supported by the server
+    """
+
+    def __init__(self, workdir: str, key: str):
+        self.key = key
+        self.__conn = sqlite3.connect(os.path.join(workdir, "manifest.db"), timeout=60)
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS listings (key TEXT, path TEXT, size INTEGER, last_modified INTEGER, is_dir INTEGER, etag TEXT, checksums TEXT, PRIMARY KEY (key, path))")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS listing_tokens (key TEXT PRIMARY KEY, token TEXT, sync_token TEXT)")
+
+    def close(self):
+        self.__conn.close()
+
+    def tokens(self) -> Tuple[Optional[str], Optional[str]]:
+        row = self.__conn.execute("SELECT token, sync_token FROM listing_tokens WHERE key = ?", (self.key,)).fetchone()
+        return (None, None) if row is None else (row[0], row[1])
+
+    def entries(self) -> Iterable[Tuple[str, int, int, bool, Optional[str], Optional[str]]]:
+        rows = self.__conn.execute("SELECT path, size, last_modified, is_dir, etag, checksums FROM listings WHERE key = ?", (self.key,))
+        return [(path, size, last_modified, is_dir == 1, etag, checksums) for path, size, last_modified, is_dir, etag, checksums in rows]
+
+    def replace(self, token: Optional[str], sync_token: Optional[str], entries: Iterable[Tuple[str, int, int, bool, Optional[str], Optional[str]]]):
+        with self.__conn:
+            self.__conn.execute("DELETE FROM listings WHERE key = ?", (self.key,))
+            self.__conn.executemany("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    ((self.key, path, size, last_modified, 1 if is_dir else 0, etag, checksums) for path, size, last_modified, is_dir, etag, checksums in entries))
+            self.__conn.execute("INSERT OR REPLACE INTO listing_tokens VALUES (?, ?, ?)", (self.key, token, sync_token))
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+
+class MetricsRegistry:
+    """
+    counters, gauges and histograms rendered in the Prometheus text format. A metric is identified by
+    its name and its labels, e.g. observe("filesync_request_seconds", {"method": "PUT"}, 0.2)
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__types = {}
+        self.__help = {}
+        self.__values = {}       # (name, labels) -> value
+        self.__histograms = {}   # (name, labels) -> [bucket counts, sum, count]
+
+    def describe(self, name: str, type: str, help: str):
+        self.__types[name] = type
+        self.__help[name] = help
+
+    def inc(self, name: str, labels: Dict[str, str], value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    def set(self, name: str, labels: Dict[str, str], value: float):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__values[key] = value
+
+    def observe(self, name: str, labels: Dict[str, str], value: float):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__histograms.get(key, None)
+            if histogram is None:
+                histogram = [[0] * len(DEFAULT_BUCKETS), 0, 0]
+                self.__histograms[key] = histogram
+            for i, bound in enumerate(DEFAULT_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self.__lock:
+            samples = {}
+            for (name, labels), value in self.__values.items():
+                samples.setdefault(name, []).append(name + self.__labels(labels) + " " + str(value))
+            for (name, labels), (buckets, sum, count) in self.__histograms.items():
+                series = samples.setdefault(name, [])
+                for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+                    series.append(name + "_bucket" + self.__labels(labels + (("le", str(bound)),)) + " " + str(bucket_count))
+                series.append(name + "_bucket" + self.__labels(labels + (("le", "+Inf"),)) + " " + str(count))
+                series.append(name + "_sum" + self.__labels(labels) + " " + str(sum))
+                series.append(name + "_count" + self.__labels(labels) + " " + str(count))
+        for name in sorted(samples.keys()):
+            if name in self.__help.keys():
+                lines.append("# HELP " + name + " " + self.__help[name])
+                lines.append("# TYPE " + name + " " + self.__types[name])
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+    def __labels(self, labels: Tuple) -> str:
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for name, value in labels) + "}"
+
+
+registry = MetricsRegistry()
+registry.describe("filesync_scan_seconds", "histogram", "duration of scanning a side of a task")
+registry.describe("filesync_request_seconds", "histogram", "latency of webdav requests")
+registry.describe("filesync_requests_total", "counter", "webdav requests by response code")
+registry.describe("filesync_throttled_total", "counter", "webdav requests rejected by 429/503")
+registry.describe("filesync_transferred_files_total", "counter", "files copied")
+registry.describe("filesync_transferred_bytes_total", "counter", "bytes copied")
+registry.describe("filesync_errors_total", "counter", "failed file copies")
+registry.describe("filesync_queue_depth", "gauge", "files waiting to be copied")
+registry.describe("filesync_run_seconds", "histogram", "duration of sync runs")
+registry.describe("filesync_last_run_timestamp_seconds", "gauge", "end of the last sync run")
+
+
+
+class RunMetrics:
+    """
+    metrics of a single sync run. They are added to the registry and summarized per run
+    """
+
+    def __init__(self, task: str):
+        self.task = task
+        self.start = time.time()
+        self.scan_sec = {}
+        self.requests = {}   # method -> [count, total latency, errors]
+        self.num_files = 0
+        self.num_bytes = 0
+        self.num_errors = 0
+        self.num_throttled = 0
+        self.max_queue_depth = 0
+        self.__lock = threading.Lock()
+
+    def observe_scan(self, provider: str, elapsed_sec: float):
+        self.scan_sec[provider] = round(elapsed_sec, 3)
+        registry.observe("filesync_scan_seconds", {"task": self.task, "provider": provider}, elapsed_sec)
+
+    def observe_request(self, host: str, method: str, elapsed_sec: float, status_code: int):
+        with self.__lock:
+            stats = self.requests.setdefault(method, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += elapsed_sec
+            if status_code >= 400:
+                stats[2] += 1
+            if status_code in (429, 503):
+                self.num_throttled += 1
+        registry.observe("filesync_request_seconds", {"host": host, "method": method}, elapsed_sec)
+        registry.inc("filesync_requests_total", {"host": host, "method": method, "code": str(status_code)})
+        if status_code in (429, 503):
+            registry.inc("filesync_throttled_total", {"host": host})
+
+    def add_transfer(self, num_bytes: int):
+        with self.__lock:
+            self.num_files += 1
+            self.num_bytes += num_bytes
+        registry.inc("filesync_transferred_files_total", {"task": self.task})
+        registry.inc("filesync_transferred_bytes_total", {"task": self.task}, num_bytes)
+
+    def add_error(self):
+        with self.__lock:
+            self.num_errors += 1
+        registry.inc("filesync_errors_total", {"task": self.task})
+
+    def set_queue_depth(self, queue_depth: int):
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        registry.set("filesync_queue_depth", {"task": self.task}, queue_depth)
+
+    def finish(self) -> Dict:
+        end = time.time()
+        registry.observe("filesync_run_seconds", {"task": self.task}, end - self.start)
+        registry.set("filesync_last_run_timestamp_seconds", {"task": self.task}, int(end))
+        return {"task": self.task,
+                "start": int(self.start),
+                "elapsed_sec": round(end - self.start, 3),
+                "scan_sec": self.scan_sec,
+                "files": self.num_files,
+                "bytes": self.num_bytes,
+                "errors": self.num_errors,
+                "throttled": self.num_throttled,
+                "max_queue_depth": self.max_queue_depth,
+                "requests": {method: {"count": count, "avg_sec": round(total / count, 4), "errors": errors} for method, (count, total, errors) in self.requests.items()}}
+
+
+# guards runs.json, which is shared by all tasks running concurrently
+runs_lock = threading.Lock()
+
+
+def store_run_summary(workdir: str, summary: Dict):
+    # <workdir>/runs.json holds the summary of the last run of each task
+    runs_file = os.path.join(workdir, "runs.json")
+    with runs_lock:
+        runs = load_run_summaries(workdir)
+        runs[summary["task"]] = summary
+        temp_file = runs_file + "." + str(os.getpid()) + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(runs, f, indent=2)
+        os.replace(temp_file, runs_file)
+
+
+def load_run_summaries(workdir: str) -> Dict:
+    runs_file = os.path.join(workdir, "runs.json")
+    if os.path.isfile(runs_file):
+        try:
+            with open(runs_file, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.warning("error occurred reading " + runs_file + " " + str(e))
+    return {}
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = registry.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/runs":
+            body = json.dumps(load_run_summaries(self.server.workdir), indent=2).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int, workdir: str, host: str = "") -> ThreadingHTTPServer:
+    # serves /metrics (Prometheus) and /runs (summaries of the last runs)
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.workdir = workdir
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    logging.info("metrics available on port " + str(httpd.server_address[1]))
+    return httpd
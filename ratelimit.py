@@ -0,0 +1,119 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+
+def retry_after_sec(value: Optional[str]) -> Optional[float]:
+    # the Retry-After header is either a number of seconds or a http date
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def backoff_sec(attempt: int, base_sec: float = 1, max_sec: float = 300) -> float:
+    # exponential backoff with full jitter. Clients throttled at the same time do not retry at the same time
+    return random.uniform(0, min(max_sec, base_sec * (2 ** attempt)))
+
+
+
+class HostLimiter:
+    """
+    limits the requests to a host by a token bucket (max_requests_per_sec, 0 = unlimited) and by a concurrency
+    limit. The concurrency limit adapts to the throttling of the host (AIMD): it is halved on each throttled
+    request and increased by one after a full window of successful requests
+    """
+
+    def __init__(self, host: str, max_concurrency: int = 10, max_requests_per_sec: float = 0):
+        self.host = host
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_requests_per_sec = max_requests_per_sec
+        self.concurrency = self.max_concurrency
+        self.__active = 0
+        self.__successes = 0
+        self.__tokens = max(1.0, max_requests_per_sec)
+        self.__refilled = time.time()
+        self.__paused_until = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while True:
+                wait_sec = self.__try_acquire()
+                if wait_sec == 0:
+                    return
+                self.__condition.wait(wait_sec)
+
+    def try_acquire(self) -> Optional[float]:
+        # non-blocking acquire (e.g. by a coroutine). 0, if acquired. Otherwise the sec to wait or None (until a release)
+        with self.__condition:
+            return self.__try_acquire()
+
+    def __try_acquire(self) -> Optional[float]:
+        # all requests to the host share the pause, so a throttled host gets a break
+        remaining = self.__paused_until - time.time()
+        if remaining > 0:
+            return remaining
+        elif self.__active >= self.concurrency:
+            return None
+        wait_sec = self.__take_token()
+        if wait_sec <= 0:
+            self.__active += 1
+            return 0
+        return wait_sec
+
+    def __take_token(self) -> float:
+        if self.max_requests_per_sec <= 0:
+            return 0
+        now = time.time()
+        self.__tokens = min(max(1.0, self.max_requests_per_sec), self.__tokens + (now - self.__refilled) * self.max_requests_per_sec)
+        self.__refilled = now
+        if self.__tokens >= 1:
+            self.__tokens -= 1
+            return 0
+        return (1 - self.__tokens) / self.max_requests_per_sec
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None):
+        with self.__condition:
+            self.__active -= 1
+            if throttled:
+                self.__successes = 0
+                self.concurrency = max(1, self.concurrency // 2)
+                pause_sec = backoff_sec(1) if retry_after is None else retry_after
+                self.__paused_until = max(self.__paused_until, time.time() + pause_sec)
+                logging.info(self.host + " throttles requests. Pausing " + str(round(pause_sec, 1)) + " sec, concurrency reduced to " + str(self.concurrency))
+            else:
+                self.__successes += 1
+                if self.__successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.__successes = 0
+                    self.concurrency += 1
+            self.__condition.notify_all()
+
+
+# one limiter per host, shared by all providers (and tasks) accessing the host
+host_limiters: Dict[str, HostLimiter] = {}
+host_limiters_lock = threading.Lock()
+
+
+def host_limiter(host: str, max_concurrency: int = 10, max_requests_per_sec: float = 0) -> HostLimiter:
+    with host_limiters_lock:
+        limiter = host_limiters.get(host, None)
+        if limiter is None:
+            limiter = HostLimiter(host, max_concurrency, max_requests_per_sec)
+            host_limiters[host] = limiter
+        else:
+            limiter.max_concurrency = max(limiter.max_concurrency, max_concurrency)
+            # the strictest rate of the providers applies. A provider without rate (0) does not lift it
+            if max_requests_per_sec > 0 and (limiter.max_requests_per_sec <= 0 or max_requests_per_sec < limiter.max_requests_per_sec):
+                limiter.max_requests_per_sec = max_requests_per_sec
+        return limiter
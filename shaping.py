@@ -0,0 +1,162 @@
+import time
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from ignore import IgnoreMatcher
+
+
+UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(value: Any) -> float:
+    # bytes (per sec), e.g. 500000, "500K", "2M". For rates, 0 or None means unlimited
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return max(0.0, float(value))
+    value = str(value).strip().upper().rstrip("B")
+    if len(value) > 0 and value[-1] in UNITS.keys():
+        return max(0.0, float(value[:-1]) * UNITS[value[-1]])
+    return max(0.0, float(value))
+
+
+def parse_time_range(text: str) -> Tuple[int, int]:
+    # "08:00-18:00" -> minutes of the day. A range may span midnight, e.g. "22:00-06:00"
+    start, end = text.split("-")
+    return tuple(int(t.split(":")[0]) * 60 + (int(t.split(":")[1]) if ":" in t else 0) for t in (start.strip(), end.strip()))
+
+
+def rate_at(profile: Any, now: datetime = None) -> float:
+    """
+    the rate of a bandwidth profile at the given time. A profile is a rate or a time of day profile like
+    {"08:00-18:00": "1M", "default": 0}
+    """
+    if not isinstance(profile, dict):
+        return parse_size(profile)
+    now = datetime.now() if now is None else now
+    minute = now.hour * 60 + now.minute
+    for key, value in profile.items():
+        if key == "default":
+            continue
+        start, end = parse_time_range(key)
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            return parse_size(value)
+    return parse_size(profile.get("default", 0))
+
+
+
+class BandwidthLimiter:
+    """
+    limits the bytes per sec by a token bucket. The rate follows a (time of day) profile and is re-evaluated
+    every minute. A limiter may have a parent limiter (e.g. shared by all tasks of a config), which applies as well
+    """
+
+    PROFILE_CHECK_SEC = 60
+
+    def __init__(self, profile: Any = 0, parent: Optional["BandwidthLimiter"] = None):
+        self.profile = profile
+        self.parent = parent
+        self.__lock = threading.Lock()
+        self.__rate = rate_at(profile)
+        self.__rate_checked = time.time()
+        self.__tokens = self.__rate
+        self.__refilled = time.time()
+
+    @property
+    def rate(self) -> float:
+        now = time.time()
+        if now - self.__rate_checked >= self.PROFILE_CHECK_SEC:
+            self.__rate_checked = now
+            self.__rate = rate_at(self.profile)
+        return self.__rate
+
+    def consume(self, num_bytes: int):
+        # blocks until the bytes may be transferred. A transfer may overdraw the bucket; following ones wait for the debt
+        wait_sec = 0
+        with self.__lock:
+            rate = self.rate
+            if rate > 0:
+                now = time.time()
+                # the burst is limited to one sec of bandwidth
+                self.__tokens = min(rate, self.__tokens + (now - self.__refilled) * rate) - num_bytes
+                self.__refilled = now
+                if self.__tokens < 0:
+                    wait_sec = -self.__tokens / rate
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+        if self.parent is not None:
+            self.parent.consume(num_bytes)
+
+
+
+class ThrottledReader:
+    """
+    file like object limiting the read bytes by a bandwidth limiter. It has a length, so it is sent with a
+    Content-Length header (instead of chunked)
+    """
+
+    def __init__(self, file, bandwidth: BandwidthLimiter, size: int):
+        self.file = file
+        self.bandwidth = bandwidth
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.bandwidth.consume(len(data))
+        return data
+
+
+
+class TransferOrder:
+    """
+    the order files are copied in. Files matching a priority pattern come first (in the order of the patterns),
+    each group is ordered by the policy: "path" (default), "smallest_first" or "newest_first"
+    """
+
+    POLICIES = ["path", "smallest_first", "newest_first"]
+
+    def __init__(self, policy: str = "path", priority_patterns: List[str] = list()):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown transfer order " + policy + " (supported: " + ", ".join(self.POLICIES) + ")")
+        self.policy = policy
+        self.priority_patterns = list(priority_patterns)
+        self.matchers = [IgnoreMatcher([pattern]) for pattern in self.priority_patterns]
+
+    def priority(self, path: str) -> int:
+        for i, matcher in enumerate(self.matchers):
+            if matcher.is_ignored(path):
+                return i
+        return len(self.matchers)
+
+    def sort(self, files: List[Tuple[Any, str]]) -> List[Tuple[Any, str]]:
+        # (file info, reason) pairs
+        if self.policy == "smallest_first":
+            key = lambda change: (self.priority(change[0].path), change[0].size, change[0].path)
+        elif self.policy == "newest_first":
+            key = lambda change: (self.priority(change[0].path), -change[0].last_modified_epoch, change[0].path)
+        else:
+            key = lambda change: (self.priority(change[0].path), change[0].path)
+        return sorted(files, key=key)
+
+    def __str__(self):
+        return self.policy + ("" if len(self.priority_patterns) == 0 else " (priority " + ", ".join(self.priority_patterns) + ")")
+
+
+# bandwidth limiters shared by name, e.g. by all tasks of a config
+bandwidth_limiters: Dict[str, BandwidthLimiter] = {}
+bandwidth_limiters_lock = threading.Lock()
+
+
+def bandwidth_limiter(name: str, profile: Any) -> BandwidthLimiter:
+    with bandwidth_limiters_lock:
+        limiter = bandwidth_limiters.get(name, None)
+        if limiter is None:
+            limiter = BandwidthLimiter(profile)
+            bandwidth_limiters[name] = limiter
+        elif limiter.profile != profile:
+            # changed by a reload of the config
+            limiter.profile = profile
+        return limiter
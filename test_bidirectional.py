@@ -0,0 +1,159 @@
+import os
+import time
+import pytest
+from webdav_server import WebDavServer, WebDavHandler
+from filesync import sync_folder
+
+
+@pytest.fixture
+def server(tmp_path):
+    os.makedirs(str(tmp_path / "remote" / "data"))
+    dav = WebDavServer(str(tmp_path / "remote")).start()
+    yield dav
+    dav.stop()
+
+
+@pytest.fixture
+def local(tmp_path):
+    os.makedirs(str(tmp_path / "local"))
+    return str(tmp_path / "local")
+
+
+def write(path: str, content: str, mtime: float = None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def files(root: str):
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root) for dirpath, _, names in os.walk(root) for name in names)
+
+
+def fail_requests(monkeypatch, method: str, name: str):
+    # requests of the method to paths containing name are answered by 500
+    handle = getattr(WebDavHandler, "do_" + method)
+    def failing(handler):
+        if name in handler.path:
+            handler.read_body()
+            return handler.reply(500)
+        return handle(handler)
+    monkeypatch.setattr(WebDavHandler, "do_" + method, failing)
+
+
+def sync(local: str, server: WebDavServer, workdir, **kwargs) -> int:
+    return sync_folder(local, server.address("/data"), workdir=str(workdir), bidirectional=True, **kwargs)
+
+
+def test_changes_and_deletions_are_synced_both_ways(tmp_path, server, local):
+    remote = server.root + "/data"
+    write(local + "/a/one.txt", "one")
+    write(local + "/a/two.txt", "two")
+    write(remote + "/b/three.txt", "three")
+    assert sync(local, server, tmp_path) == 3
+    assert files(local) == files(remote) == ["a/one.txt", "a/two.txt", "b/three.txt"]
+    assert sync(local, server, tmp_path) == 0
+
+    # a remote change is downloaded, a local deletion is deleted remotely
+    write(remote + "/b/three.txt", "three changed", time.time() + 100)
+    os.remove(local + "/a/two.txt")
+    assert sync(local, server, tmp_path) == 1
+    assert read(local + "/b/three.txt") == "three changed"
+    assert files(local) == files(remote) == ["a/one.txt", "b/three.txt"]
+    assert sync(local, server, tmp_path) == 0
+
+
+def test_conflict_keeps_older_version_as_copy(tmp_path, server, local):
+    remote = server.root + "/data"
+    write(local + "/doc.txt", "doc")
+    sync(local, server, tmp_path)
+    write(local + "/doc.txt", "local version", time.time() + 50)
+    write(remote + "/doc.txt", "remote version", time.time() + 200)
+    # the last modified time set by the upload is a property of the server
+    server.properties.pop(remote + "/doc.txt", None)
+    sync(local, server, tmp_path)
+    assert read(local + "/doc.txt") == read(remote + "/doc.txt") == "remote version"
+    conflict_copies = [name for name in files(local) if name != "doc.txt"]
+    assert len(conflict_copies) == 1 and read(local + "/" + conflict_copies[0]) == "local version"
+    # the conflict copy is a new file, which is uploaded by the next sync
+    assert sync(local, server, tmp_path) == 1
+    assert files(local) == files(remote)
+    assert sync(local, server, tmp_path) == 0
+
+
+def test_failed_upload_is_retried_and_not_deleted(tmp_path, server, local, monkeypatch):
+    remote = server.root + "/data"
+    write(local + "/old.txt", "old")
+    sync(local, server, tmp_path)
+    write(local + "/new.txt", "new")
+    with monkeypatch.context() as patch:
+        fail_requests(patch, "PUT", "new.txt")
+        sync(local, server, tmp_path)
+    assert not os.path.exists(remote + "/new.txt")
+    # not in the baseline: the missing remote file is no deletion
+    assert sync(local, server, tmp_path) == 1
+    assert read(local + "/new.txt") == read(remote + "/new.txt") == "new"
+
+
+def test_failed_deletion_is_retried(tmp_path, server, local, monkeypatch):
+    remote = server.root + "/data"
+    write(local + "/keep.txt", "keep")
+    write(local + "/gone.txt", "gone")
+    sync(local, server, tmp_path)
+    os.remove(local + "/gone.txt")
+    with monkeypatch.context() as patch:
+        fail_requests(patch, "DELETE", "gone.txt")
+        sync(local, server, tmp_path)
+    assert os.path.exists(remote + "/gone.txt")
+    # the old baseline is kept: the remote file is deleted, not downloaded again
+    sync(local, server, tmp_path)
+    assert files(local) == files(remote) == ["keep.txt"]
+
+
+def test_empty_side_suppresses_deletions(tmp_path, server, local):
+    remote = server.root + "/data"
+    write(local + "/a.txt", "a")
+    write(local + "/b.txt", "b")
+    sync(local, server, tmp_path)
+    # e.g. an unmounted drive
+    for name in files(local):
+        os.remove(local + "/" + name)
+    sync(local, server, tmp_path)
+    assert files(remote) == ["a.txt", "b.txt"]
+
+
+def test_unreadable_dir_is_not_deleted(tmp_path, server, local, monkeypatch):
+    remote = server.root + "/data"
+    write(local + "/top.txt", "top")
+    write(local + "/keep.txt", "keep")
+    write(local + "/sub/a.txt", "a")
+    write(local + "/sub/b.txt", "b")
+    sync(local, server, tmp_path)
+    scandir = os.scandir
+    def failing_scandir(path):
+        if str(path).endswith("/sub"):
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "scandir", failing_scandir)
+        os.remove(local + "/top.txt")
+        sync(local, server, tmp_path)
+    # deletions outside the unread dir are synced
+    assert files(remote) == ["keep.txt", "sub/a.txt", "sub/b.txt"]
+    # the baseline of the unread dir is kept
+    os.remove(local + "/sub/a.txt")
+    sync(local, server, tmp_path)
+    assert files(local) == files(remote) == ["keep.txt", "sub/b.txt"]
+
+
+def test_packing_is_rejected(tmp_path, server, local):
+    write(local + "/a.txt", "a")
+    assert sync(local, server, tmp_path, pack_size=64 * 1024) == 0
+    assert files(server.root + "/data") == []
+
@@ -0,0 +1,61 @@
+import os
+import gzip
+from filesync import sync_folder, storeprovider, Transfer, FileStoreProvider
+from test_bidirectional import server, local, write, read, files, fail_requests
+
+
+def sync(source: str, target: str, workdir, **kwargs) -> int:
+    return sync_folder(source, target, workdir=str(workdir), pack_size=1024, **kwargs)
+
+
+def test_files_of_failed_flush_are_not_copied(tmp_path, server, local, monkeypatch):
+    # the copied files of a transfer make the baseline. Packed files are copied, once the index has been stored
+    write(local + "/small.txt", "small")
+    write(local + "/large.txt", "x" * 4096)
+    source = FileStoreProvider(local)
+    target = storeprovider(server.address("/data"), pack_size=1024)
+    fail_requests(monkeypatch, "PUT", "index.json.gz")
+    transfer = Transfer(source, target)
+    transfer.run([(fileinfo, "new") for fileinfo in source.info_tree(False).values()])
+    assert [fileinfo.path for fileinfo in transfer.copied_files] == ["/large.txt"]
+    assert transfer.num_files_copied == 1
+    assert transfer.num_errors == 1
+
+
+def test_packed_files_are_restored(tmp_path, server, local):
+    remote = server.root + "/data"
+    write(local + "/a.txt", "a", 1500000000)
+    write(local + "/sub/b.bin", "b" * 100, 1500000000)
+    write(local + "/large.bin", "l" * 4096, 1500000000)
+    assert sync(local, server.address("/data"), tmp_path) == 3
+    # small files are stored in segments only
+    assert [name for name in files(remote) if not name.startswith(".filesync/")] == ["large.bin"]
+    assert sync(local, server.address("/data"), tmp_path) == 0
+
+    restored = str(tmp_path / "restored")
+    os.makedirs(restored)
+    assert sync(server.address("/data"), restored, tmp_path) == 3
+    assert files(restored) == files(local)
+    for name in files(local):
+        assert read(restored + "/" + name) == read(local + "/" + name)
+    assert int(os.path.getmtime(restored + "/sub/b.bin")) == 1500000000
+
+
+def test_compressed_files_are_restored(tmp_path, server, local):
+    remote = server.root + "/data"
+    log = "".join("line " + str(i) + "\n" for i in range(1000))
+    write(local + "/app.log", log, 1500000000)
+    write(local + "/image.bin", "i" * 4096, 1500000000)
+    assert sync(local, server.address("/data"), tmp_path, compress=True) == 2
+    # text like files are stored gzipped, others as they are
+    assert [name for name in files(remote) if not name.startswith(".filesync/")] == ["app.log.filesync.gz", "image.bin"]
+    with gzip.open(remote + "/app.log.filesync.gz", "rt") as f:
+        assert f.read() == log
+    assert sync(local, server.address("/data"), tmp_path, compress=True) == 0
+
+    restored = str(tmp_path / "restored")
+    os.makedirs(restored)
+    assert sync(server.address("/data"), restored, tmp_path, compress=True) == 2
+    assert files(restored) == ["app.log", "image.bin"]
+    assert read(restored + "/app.log") == log
+    assert int(os.path.getmtime(restored + "/app.log")) == 1500000000
@@ -0,0 +1,315 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, quote, urlparse
+from xml.sax.saxutils import escape
+
+
+
+class WebDavHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def dav(self):
+        return self.server.dav
+
+    def local_path(self, href: str) -> str:
+        return os.path.join(self.dav.root, unquote(urlparse(href).path).lstrip("/"))
+
+    def reply(self, code: int, body: bytes = b"", headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if len(body) > 0 and self.command != "HEAD":
+            self.dav.throttle(len(body))
+            self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = self.read_chunked()
+        else:
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length) if length > 0 else b""
+        self.dav.throttle(len(data))
+        return data
+
+    def read_chunked(self) -> bytes:
+        data = b""
+        while True:
+            size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            chunk = self.rfile.read(size + 2)   # the chunk and its CRLF
+            if size == 0:
+                return data
+            data += chunk[:-2]
+
+    def setup(self):
+        super().setup()
+        self.dav.count_connection()
+
+    def parse_request(self):
+        parsed = super().parse_request()
+        if parsed:
+            self.dav.count_request(self.command)
+        return parsed
+
+    def do_OPTIONS(self):
+        self.reply(200, headers={"DAV": "1, 2", "Allow": "OPTIONS, GET, HEAD, PUT, PATCH, DELETE, MKCOL, COPY, MOVE, PROPFIND, PROPPATCH"})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.dav.delay()
+        path = self.local_path(self.path)
+        if not os.path.exists(path):
+            return self.reply(404)
+        if os.path.isdir(path):
+            return self.reply(200)
+        size = os.path.getsize(path)
+        start, end, code = 0, size - 1, 200
+        headers = {"Last-Modified": formatdate(os.path.getmtime(path), usegmt=True), "ETag": self.dav.etag(path), "Accept-Ranges": "bytes"}
+        range_header = self.headers.get("Range")
+        if range_header is not None and range_header.startswith("bytes="):
+            first, last = range_header[len("bytes="):].split("-", 1)
+            start = int(first) if first else 0
+            end = int(last) if last else size - 1
+            if start >= size:
+                return self.reply(416, headers={"Content-Range": "bytes */" + str(size)})
+            end = min(end, size - 1)
+            code = 206
+            headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(size)
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if self.command == "GET":
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 64 * 1024))
+                    if len(chunk) == 0:
+                        break
+                    self.dav.throttle(len(chunk))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+    def do_PUT(self):
+        self.dav.delay()
+        path = self.local_path(self.path)
+        if not os.path.isdir(os.path.dirname(path)):
+            self.read_body()
+            return self.reply(409)
+        existed = os.path.exists(path)
+        with open(path, "wb") as f:
+            f.write(self.read_body())
+        self.dav.properties.pop(path, None)
+        self.reply(204 if existed else 201)
+
+    def do_PATCH(self):
+        # SabreDAV partial update
+        self.dav.delay()
+        path = self.local_path(self.path)
+        data = self.read_body()
+        if not os.path.isfile(path):
+            return self.reply(404)
+        update_range = self.headers.get("X-Update-Range", "append")
+        with open(path, "r+b") as f:
+            if update_range == "append":
+                f.seek(0, os.SEEK_END)
+            else:
+                f.seek(int(update_range[len("bytes="):].split("-", 1)[0]))
+            f.write(data)
+        self.reply(204)
+
+    def do_DELETE(self):
+        self.dav.delay()
+        path = self.local_path(self.path)
+        if not os.path.exists(path):
+            return self.reply(404)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        self.reply(204)
+
+    def do_MKCOL(self):
+        self.dav.delay()
+        self.read_body()
+        path = self.local_path(self.path)
+        if os.path.exists(path):
+            return self.reply(405)
+        if not os.path.isdir(os.path.dirname(path.rstrip("/"))):
+            return self.reply(409)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            return self.reply(405)
+        self.reply(201)
+
+    def do_MOVE(self):
+        self.copy_or_move(move=True)
+
+    def do_COPY(self):
+        self.copy_or_move(move=False)
+
+    def copy_or_move(self, move: bool):
+        self.dav.delay()
+        source = self.local_path(self.path)
+        target = self.local_path(self.headers["Destination"])
+        if not os.path.exists(source):
+            return self.reply(404)
+        existed = os.path.exists(target)
+        if existed and self.headers.get("Overwrite", "T") == "F":
+            return self.reply(412)
+        if not os.path.isdir(os.path.dirname(target.rstrip("/"))):
+            return self.reply(409)
+        if move:
+            os.replace(source, target)
+            if source in self.dav.properties:
+                self.dav.properties[target] = self.dav.properties.pop(source)
+        elif os.path.isdir(source):
+            shutil.copytree(source, target, dirs_exist_ok=True)
+        else:
+            shutil.copy2(source, target)
+            if source in self.dav.properties:
+                self.dav.properties[target] = dict(self.dav.properties[source])
+        self.reply(204 if existed else 201)
+
+    def do_PROPPATCH(self):
+        self.dav.delay()
+        body = self.read_body().decode("utf-8")
+        path = self.local_path(self.path)
+        if not os.path.exists(path):
+            return self.reply(404)
+        start = body.find("Win32LastModifiedTime")
+        if start >= 0:
+            value = body[body.index(">", start) + 1:body.index("<", start)]
+            self.dav.properties.setdefault(path, {})["Win32LastModifiedTime"] = value.strip()
+        self.reply(207, self.dav.multistatus([(self.path, None)]), {"Content-Type": "application/xml; charset=utf-8"})
+
+    def do_PROPFIND(self):
+        self.dav.delay()
+        self.read_body()
+        path = self.local_path(self.path)
+        if not os.path.exists(path):
+            return self.reply(404)
+        depth = self.headers.get("Depth", "infinity")
+        if depth == "infinity" and not self.dav.allow_depth_infinity:
+            return self.reply(403)
+        href = unquote(urlparse(self.path).path)
+        entries = [(href, path)]
+        if os.path.isdir(path) and depth != "0":
+            base = href.rstrip("/")
+            if depth == "1":
+                for name in sorted(os.listdir(path)):
+                    entries.append((base + "/" + name, os.path.join(path, name)))
+            else:
+                for dirpath, dirnames, filenames in os.walk(path):
+                    rel = os.path.relpath(dirpath, path).replace(os.sep, "/")
+                    prefix = base if rel == "." else base + "/" + rel
+                    for name in sorted(dirnames + filenames):
+                        entries.append((prefix + "/" + name, os.path.join(dirpath, name)))
+        self.reply(207, self.dav.multistatus(entries), {"Content-Type": "application/xml; charset=utf-8"})
+
+
+
+class WebDavServer:
+    """
+    minimal in-process WebDAV server serving a local directory. Stand-in for a real server in the benchmark.
+    Latency (per request) and bandwidth (per connection) can be injected
+    """
+
+    def __init__(self, root: str, latency_sec: float = 0, bandwidth: int = 0, allow_depth_infinity: bool = True, port: int = 0):
+        self.root = root
+        self.latency_sec = latency_sec
+        self.bandwidth = bandwidth   # bytes per sec per connection, 0 = unlimited
+        self.allow_depth_infinity = allow_depth_infinity
+        self.properties = {}
+        self.num_requests = {}
+        self.num_connections = 0
+        self.__lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), WebDavHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.dav = self
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:" + str(self.httpd.server_address[1])
+
+    def address(self, path: str = "", username: str = "user", password: str = "secret") -> str:
+        return "http://" + username + ":" + password + "@127.0.0.1:" + str(self.httpd.server_address[1]) + path
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counters(self):
+        with self.__lock:
+            self.num_requests = {}
+            self.num_connections = 0
+
+    def count_connection(self):
+        with self.__lock:
+            self.num_connections += 1
+
+    def count_request(self, method: str):
+        with self.__lock:
+            self.num_requests[method] = self.num_requests.get(method, 0) + 1
+
+    def delay(self):
+        if self.latency_sec > 0:
+            time.sleep(self.latency_sec)
+
+    def throttle(self, num_bytes: int):
+        if self.bandwidth > 0:
+            time.sleep(num_bytes / self.bandwidth)
+
+    def etag(self, path: str) -> str:
+        stat = os.stat(path)
+        return '"' + str(stat.st_ino) + "-" + str(stat.st_size) + "-" + str(stat.st_mtime_ns) + '"'
+
+    def ctag(self, path: str) -> str:
+        # changes on any change below the collection, like the collection etags of Nextcloud and ownCloud
+        md5 = hashlib.md5()
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in sorted(dirnames + filenames):
+                entry = os.path.join(dirpath, name)
+                md5.update((entry + self.etag(entry) + str(self.properties.get(entry, {}))).encode("utf-8"))
+        return md5.hexdigest()
+
+    def multistatus(self, entries) -> bytes:
+        responses = []
+        for href, path in entries:
+            props = ""
+            if path is not None:
+                is_dir = os.path.isdir(path)
+                stat = os.stat(path)
+                last_modified = self.properties.get(path, {}).get("Win32LastModifiedTime", formatdate(stat.st_mtime, usegmt=True))
+                props = ("<D:iscollection>" + ("true" if is_dir else "false") + "</D:iscollection>" +
+                         "<D:resourcetype>" + ("<D:collection/>" if is_dir else "") + "</D:resourcetype>" +
+                         "<D:getcontentlength>" + str(0 if is_dir else stat.st_size) + "</D:getcontentlength>" +
+                         "<D:getlastmodified>" + formatdate(stat.st_mtime, usegmt=True) + "</D:getlastmodified>" +
+                         "<D:getetag>" + escape(self.etag(path)) + "</D:getetag>" +
+                         "<ms:Win32LastModifiedTime>" + last_modified + "</ms:Win32LastModifiedTime>" +
+                         ("<cs:getctag>" + self.ctag(path) + "</cs:getctag>" if is_dir else ""))
+            responses.append("<D:response><D:href>" + escape(quote(href)) + "</D:href><D:propstat><D:prop>" + props +
+                             "</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>")
+        return ('<?xml version="1.0" encoding="utf-8"?><D:multistatus xmlns:D="DAV:" xmlns:ms="urn:schemas-microsoft-com:" xmlns:cs="http://calendarserver.org/ns/">' +
+                "".join(responses) + "</D:multistatus>").encode("utf-8")